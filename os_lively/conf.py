@@ -13,6 +13,7 @@
 # under the License.
 
 import os
+import threading
 
 
 DEFAULT_DEBUG = False
@@ -20,46 +21,173 @@ DEFAULT_ETCD_HOST = 'localhost'
 DEFAULT_ETCD_PORT = 2379
 DEFAULT_ETCD_CONNECT_TIMEOUT = 5
 DEFAULT_ETCD_KEY_NAMESPACE = ''
+DEFAULT_ETCD_POOL_SIZE = 1
 DEFAULT_STATUS_TTL = 60
+DEFAULT_READ_CACHE_TTL = None
+DEFAULT_GRPC_KEEPALIVE_TIME_MS = 10000
+DEFAULT_GRPC_KEEPALIVE_TIMEOUT_MS = 3000
+
+_KEY_SERVICES = '/services'
+
+
+def _option(overrides, name, env_var, default, cast=None):
+    """Returns the named option from the overrides if supplied, otherwise from
+    the environment variable, converted with cast, or the default.
+    """
+    if name in overrides:
+        return overrides[name]
+    val = os.environ.get(env_var)
+    if val is None:
+        return default
+    if cast is not None:
+        val = cast(val)
+    return val
 
 
 class Conf(object):
     """Configuration for os_lively healthcheck service."""
 
+    __slots__ = (
+        'debug',
+        'etcd_host',
+        'etcd_port',
+        'etcd_connect_timeout',
+        '_etcd_key_namespace',
+        'services_uri',
+        'etcd_pool_size',
+        'grpc_keepalive_time_ms',
+        'grpc_keepalive_timeout_ms',
+        'status_ttl',
+        'read_cache_ttl',
+        '_etcd_clients',
+        '_owns_clients',
+        '_client_cycle',
+        '_client_lock',
+        '_status_leases',
+        '_uuid_cache',
+        '_is_up_cache',
+        '_last_written',
+        '_watch_hub',
+        '_region_index_ready',
+    )
+
     def __init__(self, **overrides):
-        self.debug = overrides.get(
-            'debug',
-            os.environ.get('OSLIVELY_DEBUG', DEFAULT_DEBUG),
+        # Environment variables are read each time a Conf is constructed, so
+        # a malformed value raises ValueError here rather than on import.
+        self.debug = _option(
+            overrides, 'debug', 'OSLIVELY_DEBUG', DEFAULT_DEBUG,
         )
 
-        self.etcd_host = overrides.get(
-            'etcd_host',
-            os.environ.get('OSLIVELY_ETCD_HOST', DEFAULT_ETCD_HOST),
+        self.etcd_host = _option(
+            overrides, 'etcd_host', 'OSLIVELY_ETCD_HOST', DEFAULT_ETCD_HOST,
         )
-        self.etcd_port = overrides.get(
-            'etcd_port',
-            os.environ.get('OSLIVELY_ETCD_PORT', DEFAULT_ETCD_PORT),
+        self.etcd_port = _option(
+            overrides, 'etcd_port', 'OSLIVELY_ETCD_PORT', DEFAULT_ETCD_PORT,
+            int,
         )
-        self.etcd_connect_timeout = overrides.get(
+        self.etcd_connect_timeout = _option(
+            overrides,
             'etcd_connect_timeout',
-            os.environ.get(
-                'OSLIVELY_ETCD_CONNECT_TIMEOUT',
-                DEFAULT_ETCD_CONNECT_TIMEOUT,
-            ),
+            'OSLIVELY_ETCD_CONNECT_TIMEOUT',
+            DEFAULT_ETCD_CONNECT_TIMEOUT,
+            float,
         )
-        self.etcd_key_namespace = overrides.get(
+        self.etcd_key_namespace = _option(
+            overrides,
             'etcd_key_namespace',
-            os.environ.get(
-                'OSLIVELY_ETCD_KEY_NAMESPACE',
-                DEFAULT_ETCD_KEY_NAMESPACE,
-            ),
+            'OSLIVELY_ETCD_KEY_NAMESPACE',
+            DEFAULT_ETCD_KEY_NAMESPACE,
+        )
+        # Number of etcd3 clients (each with its own gRPC channel) that calls
+        # are spread across round-robin. One is enough for most callers.
+        self.etcd_pool_size = _option(
+            overrides,
+            'etcd_pool_size',
+            'OSLIVELY_ETCD_POOL_SIZE',
+            DEFAULT_ETCD_POOL_SIZE,
+            int,
         )
+        # HTTP/2 keepalive pings let the gRPC channel detect a dead or
+        # half-open etcd endpoint quickly instead of stalling callers until
+        # the TCP connection times out.
+        self.grpc_keepalive_time_ms = int(_option(
+            overrides,
+            'grpc_keepalive_time_ms',
+            'OSLIVELY_GRPC_KEEPALIVE_TIME_MS',
+            DEFAULT_GRPC_KEEPALIVE_TIME_MS,
+        ))
+        self.grpc_keepalive_timeout_ms = int(_option(
+            overrides,
+            'grpc_keepalive_timeout_ms',
+            'OSLIVELY_GRPC_KEEPALIVE_TIMEOUT_MS',
+            DEFAULT_GRPC_KEEPALIVE_TIMEOUT_MS,
+        ))
 
-        self.status_ttl = overrides.get(
-            'status_ttl',
-            os.environ.get('OSLIVELY_STATUS_TTL', DEFAULT_STATUS_TTL),
+        self.status_ttl = _option(
+            overrides, 'status_ttl', 'OSLIVELY_STATUS_TTL', DEFAULT_STATUS_TTL,
+            int,
         )
         # The minimum TTL in etcd3 is 5 seconds:
         # https://github.com/coreos/etcd/blob/\
         # 6dcd020d7da9730caf261a46378dce363c296519/lease/lessor.go#L34
         self.status_ttl = max(5, self.status_ttl)
+
+        # Seconds that is_up() results may be served from an in-process cache.
+        # None means a tenth of the status TTL (at least one second) and 0
+        # disables the cache.
+        self.read_cache_ttl = _option(
+            overrides,
+            'read_cache_ttl',
+            'OSLIVELY_READ_CACHE_TTL',
+            DEFAULT_READ_CACHE_TTL,
+        )
+
+        # The etcd3 clients (and their gRPC channels) are created lazily on
+        # first use and then shared by all calls made with this configuration,
+        # unless the caller supplies an existing client to use instead, which
+        # is then left for the caller to close.
+        client = overrides.get('etcd_client')
+        self._etcd_clients = [client] if client is not None else []
+        self._owns_clients = client is None
+        self._client_cycle = None
+        self._client_lock = threading.Lock()
+        # Status index leases, keyed by service UUID, that are kept alive on
+        # each heartbeat instead of being re-granted.
+        self._status_leases = {}
+        # (expiry time, service UUID) last resolved for a (type, host) pair by
+        # is_up().
+        self._uuid_cache = {}
+        # Recent is_up() results, keyed by service UUID.
+        self._is_up_cache = {}
+        # (serialized record, key version) last written to etcd for each
+        # service, keyed by UUID.
+        self._last_written = {}
+        # Shared watch used by all notify() subscribers, created on first use.
+        self._watch_hub = None
+
+    @property
+    def etcd_key_namespace(self):
+        return self._etcd_key_namespace
+
+    @etcd_key_namespace.setter
+    def etcd_key_namespace(self, namespace):
+        self._etcd_key_namespace = namespace
+        # Root of all service keys, recomputed only when the namespace changes
+        # rather than on every etcd operation.
+        if namespace != '':
+            self.services_uri = '/' + namespace.lstrip('/') + _KEY_SERVICES
+        else:
+            self.services_uri = _KEY_SERVICES
+        # Whether reindex() is known to have been run in this namespace, so
+        # that get_many() can use the index by region.
+        self._region_index_ready = False
+
+    def close(self):
+        """Closes any etcd3 client connections that were opened."""
+        if not self._owns_clients:
+            return
+        with self._client_lock:
+            for client in self._etcd_clients:
+                client.close()
+            self._etcd_clients = []
+            self._client_cycle = None
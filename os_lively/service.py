@@ -90,11 +90,16 @@ nova-compute worker on a specific host is up and receiving connections:
                 ...
 """
 
+import calendar
 import collections
 import datetime
+import itertools
+import threading
 import time
 
 import etcd3
+import grpc
+from six.moves import queue
 
 from os_lively import service_pb2
 
@@ -108,66 +113,168 @@ Status.ALL_STATUSES = (
     Status.DOWN,
 )
 
-_KEY_SERVICES = '/services'
+# Status code <-> name lookup tables, built once from the enum descriptor
+_STATUS_I2A = {v.number: v.name for v in service_pb2._STATUS.values}
+_STATUS_A2I = {v.name: v.number for v in service_pb2._STATUS.values}
+
 _KEY_SERVICE_BY_UUID = '/by-uuid'
 _KEY_SERVICE_BY_TYPE_HOST = '/by-type-host'
 _KEY_SERVICE_BY_STATUS = '/by-status'
 _KEY_SERVICE_BY_REGION = '/by-region'
+# Written by reindex() once every record has its per-UUID region index key
+_KEY_REGION_INDEX_READY = '/region-index-ready'
+
+# Pre-joined index prefixes, so that building a key is a single join
+_PFX_UUID = _KEY_SERVICE_BY_UUID + '/'
+_PFX_TYPE_HOST = _KEY_SERVICE_BY_TYPE_HOST + '/'
+_PFX_STATUS = _KEY_SERVICE_BY_STATUS + '/'
+_PFX_REGION = _KEY_SERVICE_BY_REGION + '/'
+_PFX_STATUS_UP = _PFX_STATUS + _STATUS_I2A[service_pb2.UP] + '/'
 
 _EMPTY_VALUE = ''  # Needs to be encode-able, so None doesn't work
 
+# etcd's default limit (--max-txn-ops) on the operations in one transaction
+_MAX_TXN_OPS = 128
 
-def _etcd_client(conf):
-    # TODO(jaypipes): Cache etcd3 client connections?
-    client = etcd3.client(
-        host=conf.etcd_host,
-        port=conf.etcd_port,
-        timeout=conf.etcd_connect_timeout,
-    )
-    return client
+# Upper bound on the number of is_up() results kept in a conf's read cache
+_READ_CACHE_MAX_SIZE = 10000
 
 
-def _key_exists(client, uri, key):
-    """Returns True if the specified key is listed in the URI/directory.
+def _grpc_options(conf):
+    """Returns the gRPC channel options used for the etcd3 client."""
+    return [
+        ('grpc.keepalive_time_ms', conf.grpc_keepalive_time_ms),
+        ('grpc.keepalive_timeout_ms', conf.grpc_keepalive_timeout_ms),
+        ('grpc.http2.max_pings_without_data', 0),
+    ]
 
-    :param uri: Directory structure to query for key
-    :param key: The key to see if exists
-    """
-    val, meta = client.get(uri + '/' + key)
-    return val is not None
 
+def _etcd_client(conf):
+    """Returns an etcd3 client for the supplied configuration.
 
-def _uri_services(conf):
-    if conf.etcd_key_namespace != '':
-        return '/' + conf.etcd_key_namespace.lstrip('/') + _KEY_SERVICES
-    return _KEY_SERVICES
+    Clients are constructed on first use and cached on the `conf` object so
+    that their gRPC channels are reused across calls instead of paying for a
+    new connection on every lookup. When `conf.etcd_pool_size` is greater than
+    one, calls are spread round-robin across that many clients.
+    """
+    clients = conf._etcd_clients
+    if not clients:
+        with conf._client_lock:
+            if not conf._etcd_clients:
+                conf._etcd_clients = [
+                    etcd3.client(
+                        host=conf.etcd_host,
+                        port=conf.etcd_port,
+                        timeout=conf.etcd_connect_timeout,
+                        grpc_options=_grpc_options(conf),
+                    )
+                    for _x in range(max(1, int(conf.etcd_pool_size)))
+                ]
+                conf._client_cycle = itertools.cycle(conf._etcd_clients)
+            clients = conf._etcd_clients
+    if len(clients) == 1:
+        return clients[0]
+    return next(conf._client_cycle)
+
+
+def _to_str(val):
+    """Returns the supplied etcd key or value as a native string."""
+    if isinstance(val, bytes) and not isinstance(val, str):
+        return val.decode('utf-8')
+    return val
 
 
 def _key_by_uuid(conf, uuid):
-    base = _uri_services(conf)
-    return base + _KEY_SERVICE_BY_UUID + '/' + uuid
+    return ''.join((conf.services_uri, _PFX_UUID, uuid))
 
 
 def _key_by_type_host(conf, type, host):
-    base = _uri_services(conf)
-    return base + _KEY_SERVICE_BY_TYPE_HOST + '/' + type + '/' + host
+    return ''.join((conf.services_uri, _PFX_TYPE_HOST, type, '/', host))
+
+
+def _key_by_status(conf, status_code, uuid=''):
+    """Returns the key of the service in the index by status, or the prefix
+    of that status's index entries if no UUID is supplied.
+    """
+    return ''.join((
+        conf.services_uri, _PFX_STATUS, _STATUS_I2A[status_code], '/', uuid,
+    ))
 
 
-def _key_by_status(conf, status_code):
-    base = _uri_services(conf)
-    return base + _KEY_SERVICE_BY_STATUS + '/' + status_itoa(status_code)
+def _key_by_region(conf, region, uuid=''):
+    """Returns the key of the service in the index by region, or the prefix
+    of that region's index entries if no UUID is supplied.
+    """
+    return ''.join((conf.services_uri, _PFX_REGION, region, '/', uuid))
+
+
+def _region_index_ready(conf):
+    """Returns whether the index by region covers every service record, which
+    is only known once reindex() has been run.
+    """
+    if not conf._region_index_ready:
+        client = _etcd_client(conf)
+        key = conf.services_uri + _KEY_REGION_INDEX_READY
+        # The marker is never removed, so only its presence is remembered
+        conf._region_index_ready = client.get(key)[0] is not None
+    return conf._region_index_ready
 
 
-def _key_by_region(conf, region):
-    base = _uri_services(conf)
-    return base + _KEY_SERVICE_BY_REGION + '/' + region
+def _read_cache_ttl(conf):
+    """Returns the number of seconds is_up() results may be served from the
+    in-process read cache.
+    """
+    if conf.read_cache_ttl is not None:
+        return float(conf.read_cache_ttl)
+    return max(1, int(conf.status_ttl) // 10)
 
 
 def _is_up_by_uuid(conf, uuid):
-    """Returns True if the service represented by the given UUID is UP."""
-    uri = _key_by_status(conf, service_pb2.UP)
+    """Returns True if the service represented by the given UUID is UP.
+
+    Results are cached on the `conf` object for a short time so that callers
+    checking the same service repeatedly, e.g. once per resource provider in a
+    scheduling pass, only hit etcd once.
+    """
+    ttl = _read_cache_ttl(conf)
+    now = time.time()
+    if ttl > 0:
+        cached = conf._is_up_cache.get(uuid)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+    client = _etcd_client(conf)
+    up_key = ''.join((conf.services_uri, _PFX_STATUS_UP, uuid))
+    # A liveness probe can tolerate a slightly stale answer, so the read is
+    # served by whichever etcd member receives it instead of going through
+    # the leader for a linearizable read.
+    res = client.get(up_key, serializable=True)[0] is not None
+
+    if ttl > 0:
+        if len(conf._is_up_cache) >= _READ_CACHE_MAX_SIZE:
+            conf._is_up_cache.clear()
+        conf._is_up_cache[uuid] = (now + ttl, res)
+    return res
+
+
+def _status_of(conf, uuid):
+    """Returns the status code of the service represented by the given UUID,
+    or None if the service is in no status index, without fetching and
+    decoding its record. All status index keys are probed in one transaction.
+    """
     client = _etcd_client(conf)
-    return _key_exists(client, uri, uuid)
+    _succeeded, responses = client.transaction(
+        compare=[],
+        success=[
+            client.transactions.get(_key_by_status(conf, st, uuid))
+            for st in Status.ALL_STATUSES
+        ],
+        failure=[],
+    )
+    for st, kvs in zip(Status.ALL_STATUSES, responses):
+        if kvs:
+            return st
+    return None
 
 
 def _get_by_uuid(conf, uuid):
@@ -186,37 +293,74 @@ def _get_by_uuid(conf, uuid):
 
 
 def _get_all(conf):
-    """Returns service represented by the given UUID or None if no such service
-    record exists.
+    """Yields every service record, decoding each one only as the caller
+    consumes it so that callers filtering the records never hold all of them
+    at once.
     """
-    uri = _uri_services(conf) + '/by-uuid/'
+    uri = conf.services_uri + _PFX_UUID
     client = _etcd_client(conf)
-    kvms = client.get_prefix(uri)
-    if not kvms:
-        return []
+    for val, _meta in client.get_prefix(uri):
+        yield Service.FromString(val)
+
+
+def _status_lease(conf, client, uuid):
+    """Returns a tuple of (lease, refreshed) for the status index key of the
+    service with the supplied UUID.
+
+    Leases are cached on the `conf` object and kept alive on each heartbeat
+    instead of granting a new lease for every update. A new lease is granted
+    when none is cached, when the configured TTL has changed or when the
+    cached lease has already expired, in which case `refreshed` is False and
+    the caller must attach the lease to the status index key.
+
+    A new lease is only cached by _record_written() once a transaction has
+    attached it. Otherwise a failed write would leave behind a cached lease
+    that later updates would keep alive without it being attached to
+    anything.
+    """
+    lease = _refresh_status_lease(conf, uuid)
+    if lease is not None:
+        return lease, True
+
+    conf._status_leases.pop(uuid, None)
+    return client.lease(ttl=conf.status_ttl), False
+
 
-    results = []
-    for val, _meta in kvms:
-        s = Service()
-        s.ParseFromString(val)
-        results.append(s)
-    return results
+def _refresh_status_lease(conf, uuid):
+    """Sends a keep-alive for the cached status lease of the service with the
+    supplied UUID and returns the lease, or returns None if there is no usable
+    cached lease.
+    """
+    lease = conf._status_leases.get(uuid)
+    if lease is not None and lease.ttl == conf.status_ttl:
+        resps = lease.refresh()
+        if resps and resps[0].TTL > 0:
+            return lease
+    return None
 
 
 def _fields_changed(orig, new):
-    """Returns a set of names of fields that changed between orig and new."""
-    changed = set()
-    fields = [f.name for f in service_pb2._SERVICE.fields]
-    for field in fields:
-        if getattr(orig, field) != getattr(new, field):
-            changed.add(field)
+    """Returns a set of names of fields that changed between orig and new.
+
+    Only the fields set to a non-default value in either message, as reported
+    by ListFields(), are compared.
+    """
+    orig_fields = {fd.name: val for fd, val in orig.ListFields()}
+    new_fields = {fd.name: val for fd, val in new.ListFields()}
+    changed = set(
+        name for name, val in new_fields.items()
+        if orig_fields.get(name) != val
+    )
+    changed.update(name for name in orig_fields if name not in new_fields)
     return changed
 
 
-def _get_uuid(conf, **filters):
+def _get_uuid(conf, serializable=False, **filters):
     """Given filter parameters, returns the UUID of a service.
 
     :param conf: `os_lively.conf.Conf` object
+    :param serializable: Whether the lookup may be served by any etcd member
+                         rather than being a linearizable read
     :param **filters: kwargs representing various lookup filters:
         type: string representing the type of service, e.g.
                       'nova-compute'
@@ -233,24 +377,18 @@ def _get_uuid(conf, **filters):
     host = filters['host']
     uri = _key_by_type_host(conf, type, host)
     client = _etcd_client(conf)
-    uuid, meta = client.get(uri)
-    return uuid
+    uuid, meta = client.get(uri, serializable=serializable)
+    return _to_str(uuid)
 
 
 def status_itoa(status_code):
     """Returns a status string matching a given status integer code."""
-    code_string_map = {
-        v.number: v.name for v in service_pb2._STATUS.values
-    }
-    return code_string_map.get(status_code)
+    return _STATUS_I2A.get(status_code)
 
 
 def status_atoi(status_string):
     """Returns a status integer code matching a given status string"""
-    string_code_map = {
-        v.name: v.number for v in service_pb2._STATUS.values
-    }
-    return string_code_map.get(status_string)
+    return _STATUS_A2I.get(status_string)
 
 
 def is_up(conf, **filters):
@@ -259,6 +397,11 @@ def is_up(conf, **filters):
 
     :note: If etcd has no record of such a service type on host, returns False
 
+    :note: The UUID found for a type and host is remembered for as long as
+           is_up() results are cached (see `read_cache_ttl`). If the service is
+           moved to another type or host within that time, is_up() may still
+           answer for it under the old type and host.
+
     :param conf: `os_lively.conf.Conf` object representing etcd connection
                  info and other configuration options
     :param **filters: kwargs representing various lookup filters:
@@ -268,14 +411,129 @@ def is_up(conf, **filters):
         uuid: UUID of the service
     """
     uuid = filters.get('uuid')
+    if uuid is not None:
+        return _is_up_by_uuid(conf, uuid)
+
+    # The UUID for a type and host rarely changes, so the last resolved UUID
+    # is remembered for as long as is_up() results are cached and checked
+    # directly, saving the index lookup round trip. The index is also
+    # consulted again when the remembered service is not UP, in case the type
+    # and host now belong to a different service.
+    type_host = (filters.get('type'), filters.get('host'))
+    ttl = _read_cache_ttl(conf)
+    now = time.time()
+    cached_uuid = None
+    cached = conf._uuid_cache.get(type_host)
+    if cached is not None and cached[0] > now:
+        cached_uuid = cached[1]
+        if _is_up_by_uuid(conf, cached_uuid):
+            return True
+
+    uuid = _get_uuid(conf, serializable=True, **filters)
     if uuid is None:
-        uuid = _get_uuid(conf, **filters)
-    if uuid is None:
+        conf._uuid_cache.pop(type_host, None)
         return False
 
+    if ttl > 0:
+        if len(conf._uuid_cache) >= _READ_CACHE_MAX_SIZE:
+            conf._uuid_cache.clear()
+        conf._uuid_cache[type_host] = (now + ttl, uuid)
+    if uuid == cached_uuid:
+        return False
     return _is_up_by_uuid(conf, uuid)
 
 
+def get_status(conf, **filters):
+    """Returns the status code of the specified service, or None if etcd has
+    no record of the service or its status has expired.
+
+    Only the status index is consulted, so this is cheaper than get_one() for
+    callers that need nothing but the status.
+
+    :param conf: `os_lively.conf.Conf` object representing etcd connection
+                 info and other configuration options
+    :param **filters: kwargs representing various lookup filters:
+        type: string representing the type of service, e.g.
+                      'nova-compute'
+        host: IP address or hostname
+        uuid: UUID of the service
+    """
+    uuid = filters.get('uuid')
+    if uuid is None:
+        uuid = _get_uuid(conf, **filters)
+    if uuid is None:
+        return None
+    return _status_of(conf, uuid)
+
+
+def is_up_many(conf, type=None, hosts=None, uuids=None):
+    """Returns a dict of whether each of the specified services is UP and
+    receiving requests, keyed by UUID if `uuids` is supplied and otherwise by
+    host.
+
+    Unlike calling is_up() once per service, the number of requests made to
+    etcd does not grow with the number of services checked: at most two range
+    requests are issued for a type and hosts, and a single transaction (or
+    one range request for large lists) for UUIDs.
+
+    :param conf: `os_lively.conf.Conf` object representing etcd connection
+                 info and other configuration options
+    :param type: string representing the type of service, e.g.
+                 'nova-compute'
+    :param hosts: list of IP addresses or hostnames the services of `type`
+                  are on
+    :param uuids: list of UUIDs of the services
+    """
+    if uuids is not None:
+        return _is_up_by_uuids(conf, uuids)
+    if type is None or hosts is None:
+        raise ValueError(
+            "'type' and 'hosts' required when not specifying 'uuids'"
+        )
+
+    client = _etcd_client(conf)
+
+    type_prefix = _key_by_type_host(conf, type, '')
+    uuid_by_host = {}
+    for val, meta in client.get_prefix(type_prefix):
+        host = _to_str(meta.key)[len(type_prefix):]
+        uuid_by_host[host] = _to_str(val)
+
+    up_uuids = _up_uuids(conf)
+    return {host: uuid_by_host.get(host) in up_uuids for host in hosts}
+
+
+def _up_uuids(conf):
+    """Returns the set of UUIDs of all services that are UP."""
+    client = _etcd_client(conf)
+    up_prefix = conf.services_uri + _PFX_STATUS_UP
+    return set(
+        _to_str(meta.key)[len(up_prefix):]
+        for _val, meta in client.get_prefix(up_prefix)
+    )
+
+
+def _is_up_by_uuids(conf, uuids):
+    """Returns a dict, keyed by UUID, of whether each service is UP."""
+    if len(uuids) > _MAX_TXN_OPS:
+        # Listing the whole UP index is cheaper than several transactions
+        up_uuids = _up_uuids(conf)
+        return {uuid: uuid in up_uuids for uuid in uuids}
+
+    client = _etcd_client(conf)
+    _succeeded, responses = client.transaction(
+        compare=[],
+        success=[
+            client.transactions.get(
+                ''.join((conf.services_uri, _PFX_STATUS_UP, uuid)),
+            )
+            for uuid in uuids
+        ],
+        failure=[],
+    )
+    return {uuid: bool(kvs) for uuid, kvs in zip(uuids, responses)}
+
+
 def get_one(conf, **filters):
     """Given a set of filters, returns a single service record matching those
     filters, or None if no service record was found.
@@ -298,8 +556,16 @@ def get_one(conf, **filters):
 
 
 def get_many(conf, **filters):
-    """Given a set of filters, returns a single service record matching those
-    filters, or None if no service record was found.
+    """Given a set of filters, yields the service records matching those
+    filters.
+
+    Records are fetched and decoded as the caller consumes them, so a caller
+    that stops early, e.g. once it finds the service it is looking for, skips
+    the remaining work.
+
+    Candidate services are looked up using the most selective etcd index that
+    applies to the filters (UUID, then type and host, then region, then type),
+    and only the matching records are fetched.
 
     :param conf: `os_lively.conf.Conf` object representing etcd connection
                  info and other configuration options
@@ -312,45 +578,117 @@ def get_many(conf, **filters):
         region: One or more regions the service is in
         uuid: One or more UUIDs to search for
     """
-    # TODO(jaypipes): Obviously this isn't efficient at all, since we're not
-    # using the indexes. Perhaps do some stuff to increase the performance of
-    # this particular function in the future.
-    conds = []
-    uuids = filters.get('uuid', [])
-    if not isinstance(uuids, list):
-        uuids = [uuids]
+    uuids = _filter_values(filters, 'uuid')
+    regions = _filter_values(filters, 'region')
+    types = _filter_values(filters, 'type')
+    hosts = _filter_values(filters, 'host')
+    predicate = _filter_predicate(filters)
+
+    candidates = _plan_candidates(conf, uuids, types, hosts, regions)
+    if candidates is None:
+        results = _get_all(conf)
+    else:
+        results = _get_by_uuids(conf, candidates)
+    for res in results:
+        if predicate(res):
+            yield res
+
+
+def _filter_values(filters, name):
+    """Returns the list of values supplied for the named filter."""
+    values = filters.get(name, [])
+    if not isinstance(values, list):
+        values = [values]
+    return values
+
+
+def _filter_predicate(filters):
+    """Returns a function that tells whether a service record matches the
+    supplied get_many()-style filters.
+    """
+    uuids = frozenset(_filter_values(filters, 'uuid'))
+    regions = frozenset(_filter_values(filters, 'region'))
+    statuses = frozenset(_filter_values(filters, 'status'))
+    types = frozenset(_filter_values(filters, 'type'))
+    hosts = frozenset(_filter_values(filters, 'host'))
+
+    def predicate(s):
+        if uuids and s.uuid not in uuids:
+            return False
+        if regions and s.region not in regions:
+            return False
+        if statuses and s.status not in statuses:
+            return False
+        if types and s.type not in types:
+            return False
+        if hosts and s.host not in hosts:
+            return False
+        return True
+
+    return predicate
+
+
+def _plan_candidates(conf, uuids, types, hosts, regions):
+    """Returns the set of UUIDs of services that may match the supplied
+    filters, looked up using the most selective etcd index available, or None
+    if no index applies and all services need to be scanned.
+
+    The status index is deliberately not used: its keys expire along with the
+    status lease, so it would miss services that are no longer heartbeating.
+    """
     if uuids:
-        conds.append(lambda s: s.uuid in uuids)
-
-    regions = filters.get('region', [])
-    if not isinstance(regions, list):
-        regions = [regions]
-    if regions:
-        conds.append(lambda s: s.region in regions)
-
-    statuses = filters.get('status', [])
-    if not isinstance(statuses, list):
-        statuses = [statuses]
-    if statuses:
-        conds.append(lambda s: s.status in statuses)
-
-    types = filters.get('type', [])
-    if not isinstance(types, list):
-        types = [types]
+        return set(uuids)
+
+    client = _etcd_client(conf)
+    if types and hosts:
+        candidates = set()
+        for type in types:
+            for host in hosts:
+                uuid, _meta = client.get(_key_by_type_host(conf, type, host))
+                if uuid is not None:
+                    candidates.add(_to_str(uuid))
+        return candidates
+
+    # Records created by older releases are missing from the index by region
+    # until reindex() has been run
+    if regions and _region_index_ready(conf):
+        candidates = set()
+        for region in regions:
+            prefix = _key_by_region(conf, region)
+            for _val, meta in client.get_prefix(prefix):
+                candidates.add(_to_str(meta.key)[len(prefix):])
+        return candidates
+
     if types:
-        conds.append(lambda s: s.type in types)
+        candidates = set()
+        for type in types:
+            prefix = _key_by_type_host(conf, type, '')
+            for uuid, _meta in client.get_prefix(prefix):
+                candidates.add(_to_str(uuid))
+        return candidates
 
-    hosts = filters.get('host', [])
-    if not isinstance(hosts, list):
-        hosts = [hosts]
-    if hosts:
-        conds.append(lambda s: s.host in hosts)
+    return None
 
-    results = _get_all(conf)
-    return [
-        res for res in results
-        if all(cond(res) for cond in conds)
-    ]
+
+def _get_by_uuids(conf, uuids):
+    """Yields the service records for the supplied UUIDs, skipping any that
+    do not exist, fetched with as few transactions as etcd allows.
+    """
+    client = _etcd_client(conf)
+    uuids = sorted(uuids)
+    for start in range(0, len(uuids), _MAX_TXN_OPS):
+        ops = [
+            client.transactions.get(_key_by_uuid(conf, uuid))
+            for uuid in uuids[start:start + _MAX_TXN_OPS]
+        ]
+        _succeeded, responses = client.transaction(
+            compare=[],
+            success=ops,
+            failure=[],
+        )
+        for kvs in responses:
+            for val, _meta in kvs:
+                yield Service.FromString(val)
 
 
 def delete(conf, **filters):
@@ -373,33 +711,124 @@ def delete(conf, **filters):
     if uuid is None:
         return None
 
-    s = _get_by_uuid(conf, uuid)[0]
-    type = s.type
-    host = s.host
-    uuid = s.uuid
-    region = s.region
-
     uuid_key = _key_by_uuid(conf, uuid)
-    type_host_key = _key_by_type_host(conf, type, host)
-    region_key = _key_by_region(conf, region)
+    last = conf._last_written.get(uuid)
+    if last is not None:
+        # Assume the record in etcd is still the one we last wrote instead of
+        # reading it back. If it has changed since, the transaction fails and
+        # returns the current record instead.
+        s = Service.FromString(last[0])
+        version = last[1]
+    else:
+        s, meta = _get_by_uuid(conf, uuid)
+        if s is None:
+            return None
+        version = meta.version
+
+    while True:
+        # The status key is read before it is deleted, for its lease
+        status_key = _key_by_status(conf, s.status, uuid)
+        on_success = [client.transactions.get(status_key)]
+        on_success.extend(_delete_ops(conf, client, s))
+        res = client.transaction(
+            compare=[client.transactions.version(uuid_key) == version],
+            success=on_success,
+            failure=[client.transactions.get(uuid_key)],
+        )
+        if res[0]:
+            _revoke_status_lease(client, res[1][0])
+            break
+        kvs = res[1][0]
+        if not kvs:
+            s = None
+            break
+        val, meta = kvs[0]
+        s = Service.FromString(val)
+        version = meta.version
+
+    conf._status_leases.pop(uuid, None)
+    conf._is_up_cache.pop(uuid, None)
+    conf._last_written.pop(uuid, None)
+    if s is None:
+        return None
+    conf._uuid_cache.pop((s.type, s.host), None)
+    return res
 
-    status_trxs = []
+
+def _revoke_status_lease(client, status_kvs):
+    """Revokes the lease of a deleted service's status index key, so that the
+    service's owner, which may be another process, finds its lease gone on
+    the next heartbeat and registers the service again.
+    """
+    for _val, meta in status_kvs:
+        if not meta.lease_id:
+            continue
+        try:
+            client.revoke_lease(meta.lease_id)
+        except (etcd3.exceptions.Etcd3Exception, grpc.RpcError):
+            # The lease has already expired or etcd is unavailable, in which
+            # case the lease expires on its own
+            pass
+
+
+def _delete_ops(conf, client, s):
+    """Returns the transaction operations that delete the supplied service
+    record and all of its index entries.
+    """
+    uuid = s.uuid
+    ops = [
+        # Remove the service message blob from the primary UUID index
+        client.transactions.delete(_key_by_uuid(conf, uuid)),
+        # Remove the UUID from the index by service type and host
+        client.transactions.delete(_key_by_type_host(conf, s.type, s.host)),
+        # Remove the UUID from the index by region
+        client.transactions.delete(_key_by_region(conf, s.region, uuid)),
+    ]
     for st in Status.ALL_STATUSES:
         # Make sure the uuid is removed from any index
-        status_key = _key_by_status(conf, st) + '/' + uuid
-        trx = client.transactions.delete(status_key)
-        status_trxs.append(trx)
+        ops.append(client.transactions.delete(_key_by_status(conf, st, uuid)))
+    return ops
 
-    on_success = [
-        # Add the service message blob in the primary UUID index
-        client.transactions.delete(uuid_key),
-        # Add the UUID to the index by service type and host
-        client.transactions.delete(type_host_key),
-        # Add the UUID to the index by region
-        client.transactions.delete(region_key),
-    ]
-    on_success.extend(status_trxs)
-    return client.transaction(compare=[], success=on_success, failure=[])
+
+def reindex(conf):
+    """Rebuilds the index by region from the service records.
+
+    Older releases created services with a single /by-region/<region> key
+    shared by the whole region, rather than one key per service UUID. Until
+    this has been run once, get_many() falls back to scanning every service
+    record when filtering by region. Run it after every process writing
+    service records has been upgraded; on a new deployment it only writes the
+    marker that enables the index. Records that change while this runs may
+    leave stale index entries, which get_many() skips.
+
+    :param conf: `os_lively.conf.Conf` object representing etcd connection
+                 info and other configuration options
+    """
+    client = _etcd_client(conf)
+    ops = []
+    for val, _meta in client.get_prefix(_key_by_uuid(conf, '')):
+        s = Service.FromString(val)
+        region_key = _key_by_region(conf, s.region, s.uuid)
+        ops.append(client.transactions.put(region_key, value=_EMPTY_VALUE))
+
+    # Remove the keys written by older releases
+    region_prefix = conf.services_uri + _PFX_REGION
+    for _val, meta in client.get_prefix(region_prefix, keys_only=True):
+        key = _to_str(meta.key)
+        if '/' not in key[len(region_prefix):]:
+            ops.append(client.transactions.delete(key))
+
+    for start in range(0, len(ops), _MAX_TXN_OPS):
+        client.transaction(
+            compare=[],
+            success=ops[start:start + _MAX_TXN_OPS],
+            failure=[],
+        )
+
+    # Written last, so that get_many() keeps scanning until every record has
+    # been reindexed
+    client.put(conf.services_uri + _KEY_REGION_INDEX_READY, '1')
+    conf._region_index_ready = True
 
 
 def down(conf, maint_note=None, maint_start=None, maint_end=None, **filters):
@@ -415,16 +844,21 @@ def down(conf, maint_note=None, maint_start=None, maint_end=None, **filters):
                         (seconds since epoch)
     :param maint_end: Optional maintenance end time. You may pass a datetime or
                       a UNIX timestamp (seconds since epoch)
+
+    Naive datetimes are taken to be in UTC, not local time.
     """
     if maint_note is not None:
         if maint_start is None:
-            maint_start = datetime.datetime.utcnow()
+            maint_start = int(time.time())
 
+    # Convert datetimes with timegm() rather than mktime(), which would treat
+    # them as local time. utctimetuple() converts aware datetimes to UTC and
+    # leaves naive ones as they are.
     if isinstance(maint_start, datetime.datetime):
-        maint_start = int(time.mktime(maint_start.timetuple()))
+        maint_start = calendar.timegm(maint_start.utctimetuple())
 
     if isinstance(maint_end, datetime.datetime):
-        maint_end = int(time.mktime(maint_end.timetuple()))
+        maint_end = calendar.timegm(maint_end.utctimetuple())
 
     s = get_one(conf, **filters)
     if s is None:
@@ -444,36 +878,153 @@ def down(conf, maint_note=None, maint_start=None, maint_end=None, **filters):
 def update(conf, service):
     """Sets the service record in etcd.
 
-    The service record is set with a configurable TTL.
+    The service record is set with a configurable TTL. Calling update() again
+    for an unchanged service keeps the existing status lease alive rather than
+    rewriting any keys, and if the record is the one last written with this
+    `conf`, without reading it back from etcd either.
 
     :param conf: `os_lively.conf.Conf` object representing etcd connection
                  info and other configuration options
     :param service: `os_lively.service.Service` message object representing
                     the service record.
     """
-    changed = set()
-    existing, existing_meta = _get_by_uuid(conf, service.uuid)
-    if existing:
-        changed = _fields_changed(existing, service)
-        if not changed:
-            return True, []
+    client = _etcd_client(conf)
+    uuid = service.uuid
+    conf._is_up_cache.pop(uuid, None)
+    status_lease, refreshed = _status_lease(conf, client, uuid)
+    payload = service.SerializeToString()
+
+    last = conf._last_written.get(uuid)
+    if last is not None:
+        last_payload, last_version = last
+        if refreshed and last_payload == payload:
+            # This is the record we last wrote for the service, so nothing
+            # but the TTL needed updating and the keep-alive on the status
+            # lease has already taken care of that.
+            return True, status_lease
+
+        # Optimistically assume the record in etcd is still the one we last
+        # wrote and diff against that instead of reading it back first. If
+        # someone else has changed it since, the transaction's failure branch
+        # returns the current record and we go again from there.
+        existing = Service.FromString(last_payload)
+        uuid_key = _key_by_uuid(conf, uuid)
+        res = _update_trx(
+            conf, client, service, payload, existing, last_version,
+            status_lease, refreshed,
+            failure=[client.transactions.get(uuid_key)],
+        )
+        if res[0]:
+            return res, status_lease
+        kvs = res[1][0]
+        existing, existing_meta = None, None
+        if kvs:
+            existing = Service.FromString(kvs[0][0])
+            existing_meta = kvs[0][1]
+    else:
+        existing, existing_meta = _get_by_uuid(conf, uuid)
 
     if not existing:
-        return _new_service_trx(conf, service)
+        return _new_service_trx(conf, service, status_lease, payload)
+
+    if refreshed and not _fields_changed(existing, service):
+        conf._last_written[uuid] = (payload, existing_meta.version)
+        return True, status_lease
+
+    res = _update_trx(
+        conf, client, service, payload, existing, existing_meta.version,
+        status_lease, refreshed,
+    )
+    return res, status_lease
+
 
+def update_many(conf, services):
+    """Updates or creates the supplied services' records, as if update() had
+    been called for each of them.
+
+    Records for services that do not exist yet in etcd are created together,
+    in as few transactions as etcd allows, rather than with several requests
+    per service, which makes registering many services at once much faster.
+    Each service still gets its own status lease.
+
+    :param conf: `os_lively.conf.Conf` object representing etcd connection
+                 info and other configuration options
+    :param services: iterable of `os_lively.service.Service` protobuffer
+                     message objects
+    """
     client = _etcd_client(conf)
+    services = list(services)
+    # Services whose records we last wrote are known to exist, so only the
+    # remaining ones need checking
+    unknown = [s.uuid for s in services if s.uuid not in conf._last_written]
+    existing = set(s.uuid for s in _get_by_uuids(conf, unknown))
+    existing.update(conf._last_written)
+
+    new = []
+    for s in services:
+        if s.uuid in existing:
+            update(conf, s)
+        else:
+            new.append(s)
+
+    # Each new service takes four operations
+    per_trx = _MAX_TXN_OPS // 4
+    for start in range(0, len(new), per_trx):
+        chunk = new[start:start + per_trx]
+        compare = []
+        on_success = []
+        payloads = []
+        leases = []
+        for s in chunk:
+            conf._is_up_cache.pop(s.uuid, None)
+            status_lease, _refreshed = _status_lease(conf, client, s.uuid)
+            leases.append(status_lease)
+            payload = s.SerializeToString()
+            payloads.append(payload)
+            cmp_ops, success_ops = _new_service_ops(
+                conf, client, s, status_lease, payload,
+            )
+            compare.extend(cmp_ops)
+            on_success.extend(success_ops)
+        res = client.transaction(
+            compare=compare,
+            success=on_success,
+            failure=[],
+        )
+        if not res[0]:
+            # Some of the services were created by someone else in the
+            # meantime, so fall back to updating them one at a time. Their
+            # status keys may be attached to the other writer's leases, so
+            # any cached lease is dropped to make update() attach a new one.
+            for s in chunk:
+                conf._status_leases.pop(s.uuid, None)
+                update(conf, s)
+            continue
+        for s, payload, status_lease in zip(chunk, payloads, leases):
+            _record_written(conf, s.uuid, payload, 1, res, status_lease)
+
+
+def _update_trx(conf, client, service, payload, existing, version,
+                status_lease, refreshed, failure=()):
+    """Writes the changes between the existing and new service records, and
+    the new record itself, in a single transaction that only succeeds if the
+    primary record is still at the supplied version.
+    """
     uuid = service.uuid
-    status_lease = client.lease(ttl=conf.status_ttl)
+    changed = _fields_changed(existing, service)
 
     on_success = []
 
-    if 'status' in changed:
-        old_status = existing.status
-        old_status_key = _key_by_status(conf, old_status) + '/' + uuid
-        trx = client.transactions.delete(old_status_key)
-        on_success.append(trx)
+    if 'status' in changed or not refreshed:
+        # A newly-granted lease must be attached to the status index key,
+        # even if the status itself has not changed.
+        if 'status' in changed:
+            old_status = existing.status
+            old_status_key = _key_by_status(conf, old_status, uuid)
+            trx = client.transactions.delete(old_status_key)
+            on_success.append(trx)
         new_status = service.status
-        new_status_key = _key_by_status(conf, new_status) + '/' + uuid
+        new_status_key = _key_by_status(conf, new_status, uuid)
         trx = client.transactions.put(
             new_status_key,
             value=_EMPTY_VALUE,
@@ -495,14 +1046,15 @@ def update(conf, service):
             value=uuid,
         )
         on_success.append(trx)
+        conf._uuid_cache.pop((old_type, old_host), None)
 
     if 'region' in changed:
         old_region = existing.region
-        old_region_key = _key_by_region(conf, old_region) + '/' + uuid
+        old_region_key = _key_by_region(conf, old_region, uuid)
         trx = client.transactions.delete(old_region_key)
         on_success.append(trx)
         new_region = service.region
-        new_region_key = _key_by_region(conf, new_region) + '/' + uuid
+        new_region_key = _key_by_region(conf, new_region, uuid)
         trx = client.transactions.put(
             new_region_key,
             value=_EMPTY_VALUE,
@@ -511,36 +1063,125 @@ def update(conf, service):
 
     # Update the primary service record...
     uuid_key = _key_by_uuid(conf, uuid)
-    payload = service.SerializeToString()
     trx = client.transactions.put(uuid_key, value=payload)
     on_success.append(trx)
 
     compare = [
-        client.transactions.version(uuid_key) == existing_meta.version,
+        client.transactions.version(uuid_key) == version,
     ]
     res = client.transaction(
         compare=compare,
         success=on_success,
-        failure=[],
+        failure=list(failure),
     )
-    return res, status_lease
+    _record_written(conf, uuid, payload, version + 1, res, status_lease)
+    return res
+
 
+def _record_written(conf, uuid, payload, version, trx_result,
+                    status_lease=None):
+    """Remembers the service record payload written by a transaction along
+    with the version of the primary record key it resulted in, and the status
+    lease the transaction attached to the status index key, or forgets any
+    remembered payload if the transaction failed.
+    """
+    if trx_result[0]:
+        conf._last_written[uuid] = (payload, version)
+        if status_lease is not None:
+            conf._status_leases[uuid] = status_lease
+    else:
+        conf._last_written.pop(uuid, None)
+
+
+class Heartbeat(object):
+    """Handle for a background heartbeat started with start_heartbeat()."""
+
+    def __init__(self, conf, service, interval):
+        self.conf = conf
+        self.service = service
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            name='os-lively-heartbeat-' + service.uuid,
+            target=self._run,
+        )
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Stops sending heartbeats and waits for the heartbeat thread to
+        exit. The service's status key expires once its TTL elapses.
+        """
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                if _refresh_status_lease(self.conf, self.service.uuid):
+                    continue
+                # The lease expired (or the status TTL was changed), so fall
+                # back to a full update, which grants a new lease and attaches
+                # it to the status index key.
+                self.conf._status_leases.pop(self.service.uuid, None)
+                update(self.conf, self.service)
+            except etcd3.exceptions.Etcd3Exception:
+                # etcd is unavailable; try again on the next interval
+                pass
+
+
+def start_heartbeat(conf, service, interval=None):
+    """Registers the service with update() and then keeps its status alive
+    from a background thread, returning a `Heartbeat` handle whose stop()
+    method ends the heartbeat.
+
+    Each heartbeat is a single lease keep-alive request rather than a full
+    update(), so no keys are rewritten while the service is unchanged. Call
+    update() as usual when the service record itself changes.
+
+    :param conf: `os_lively.conf.Conf` object representing etcd connection
+                 info and other configuration options
+    :param service: `os_lively.service.Service` message object representing
+                    the service record.
+    :param interval: Optional number of seconds between heartbeats. Defaults
+                     to a third of the configured status TTL.
+    """
+    if interval is None:
+        interval = int(conf.status_ttl) / 3.0
+    update(conf, service)
+    heartbeat = Heartbeat(conf, service, interval)
+    heartbeat.start()
+    return heartbeat
 
-def _new_service_trx(conf, service):
+
+def _new_service_trx(conf, service, status_lease, payload):
     client = _etcd_client(conf)
-    status_lease = client.lease(ttl=conf.status_ttl)
+    compare, on_success = _new_service_ops(
+        conf, client, service, status_lease, payload,
+    )
+    res = client.transaction(compare=compare, success=on_success, failure=[])
+    # A newly-created key is at version 1
+    _record_written(conf, service.uuid, payload, 1, res, status_lease)
+    return res, status_lease
+
 
+def _new_service_ops(conf, client, service, status_lease, payload):
+    """Returns a tuple of (compare, success) transaction operations that
+    create the supplied service's record and index entries, provided the
+    record does not already exist.
+    """
     type = service.type
     status = service.status
     host = service.host
     uuid = service.uuid
     region = service.region
-    payload = service.SerializeToString()
 
     uuid_key = _key_by_uuid(conf, uuid)
     type_host_key = _key_by_type_host(conf, type, host)
-    region_key = _key_by_region(conf, region)
-    status_key = _key_by_status(conf, status) + '/' + uuid
+    region_key = _key_by_region(conf, region, uuid)
+    status_key = _key_by_status(conf, status, uuid)
 
     on_success = [
         # Add the service message blob in the primary UUID index
@@ -559,8 +1200,7 @@ def _new_service_trx(conf, service):
     compare = [
         client.transactions.version(uuid_key) == 0,
     ]
-    res = client.transaction(compare=compare, success=on_success, failure=[])
-    return res, status_lease
+    return compare, on_success
 
 
 NotifyResult = collections.namedtuple('NotifyResult', 'events cancel')
@@ -568,26 +1208,276 @@ NotifyResult = collections.namedtuple('NotifyResult', 'events cancel')
 
 def notify(conf, **filters):
     """Returns a structure containing an iterator and a cancellation callback.
-    The iterator yields a service message every time there is an update to the
-    service.
+    The iterator yields an etcd event every time there is an update to the
+    matching service(s).
 
-    Returns None if no such service record could be found.
+    When the filters identify a single service (by UUID, or by type and host)
+    only events for that service are yielded. Otherwise the filters are
+    applied to each updated service record the same way get_many() applies
+    them, and an event is yielded if the service matched the filters either
+    before or after the change, so that services leaving the filters (e.g.
+    going DOWN, moving to another region or being deleted) are seen too.
+
+    Only changes to the service records themselves produce events. In
+    particular, a service whose status lease expires is not reported to
+    subscribers filtering on status, because only its status index key is
+    removed and its record still says UP.
+
+    Returns None if the filters identify a single service but no such service
+    record could be found.
 
     :param conf: `os_lively.conf.Conf` object representing etcd connection
                  info and other configuration options
     :param **filters: kwargs representing various lookup filters:
-        type: string representing the type of service, e.g.
-                      'nova-compute'
-        host: IP address or hostname
+        status: One or more status codes representing the statuses the matched
+                services should be in
+        type: One or more strings representing the type of service, e.g.
+              'nova-compute'
+        host: One or more IP addresses or hostnames the service is on
+        region: One or more regions the service is in
         uuid: UUID of the service
     """
-    client = _etcd_client(conf)
     uuid = filters.get('uuid')
-    if uuid is None:
-        uuid = _get_uuid(client, **filters)
+    if uuid is None or isinstance(uuid, list):
+        # A single type and host identify exactly one service
+        single = set(filters) == set(('type', 'host'))
+        if any(isinstance(v, list) for v in filters.values()):
+            single = False
+        if filters and not single:
+            return _watch_hub(conf).subscribe(
+                predicate=_filter_predicate(filters),
+            )
+        uuid = _get_uuid(conf, **filters)
     if uuid is None:
         return None
 
-    uri = _key_by_uuid(conf, uuid)
-    it, cancel = client.watch(uri)
-    return NotifyResult(events=it, cancel=cancel)
+    return _watch_hub(conf).subscribe(uuid=uuid)
+
+
+class _WatchHub(object):
+    """Multiplexes all notify() subscribers for a configuration onto a single
+    etcd watch of the by-uuid prefix, fanning each event out to the queues of
+    the subscribers of the service the event is for, and of the subscribers
+    whose filters match the updated service record.
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.prefix = _key_by_uuid(conf, '')
+        self.lock = threading.Lock()
+        # Maps service UUID to a list of (queue, None) subscriber tuples. The
+        # None key maps to (queue, predicate) tuples of filtered subscribers.
+        self.subscribers = {}
+        # Cancellation callback of the active etcd watch, if any
+        self.cancel_watch = None
+
+    def subscribe(self, uuid=None, predicate=None):
+        q = queue.Queue()
+        sub = (q, predicate)
+        with self.lock:
+            self.subscribers.setdefault(uuid, []).append(sub)
+            if self.cancel_watch is None:
+                client = _etcd_client(self.conf)
+                # The previous record is needed to match filtered
+                # subscribers against deleted services
+                events, cancel_watch = client.watch_prefix(
+                    self.prefix, prev_kv=True,
+                )
+                self.cancel_watch = cancel_watch
+                t = threading.Thread(
+                    name='os-lively-watch',
+                    target=self._dispatch,
+                    args=(events, cancel_watch),
+                )
+                t.daemon = True
+                t.start()
+
+        def cancel():
+            self.unsubscribe(uuid, sub)
+
+        return NotifyResult(events=iter(q.get, None), cancel=cancel)
+
+    def unsubscribe(self, uuid, sub):
+        cancel_watch = None
+        with self.lock:
+            subs = self.subscribers.get(uuid, [])
+            if sub in subs:
+                subs.remove(sub)
+            if not subs:
+                self.subscribers.pop(uuid, None)
+            if not self.subscribers:
+                cancel_watch = self.cancel_watch
+                self.cancel_watch = None
+        # Ends the subscriber's events iterator
+        sub[0].put(None)
+        if cancel_watch is not None:
+            cancel_watch()
+
+    def _dispatch(self, events, cancel_watch):
+        prefix_len = len(self.prefix)
+        try:
+            for event in events:
+                key = _to_str(event.key)
+                with self.lock:
+                    subs = list(self.subscribers.get(key[prefix_len:], ()))
+                    filtered = list(self.subscribers.get(None, ()))
+                for q, _predicate in subs:
+                    q.put(event)
+                if not filtered:
+                    continue
+                # Events are matched against the record both before and after
+                # the change, so that subscribers also see services leave
+                # their filters, e.g. by going DOWN or being deleted
+                records = []
+                for value in (event.prev_value, event.value):
+                    if value:
+                        records.append(Service.FromString(value))
+                for q, predicate in filtered:
+                    if any(predicate(s) for s in records):
+                        q.put(event)
+        finally:
+            # If the watch ended without being cancelled (e.g. the client was
+            # closed), terminate the iterators of all remaining subscribers.
+            with self.lock:
+                if self.cancel_watch is not cancel_watch:
+                    return
+                subs = [sub for ss in self.subscribers.values() for sub in ss]
+                self.subscribers = {}
+                self.cancel_watch = None
+            for q, _predicate in subs:
+                q.put(None)
+
+
+def _watch_hub(conf):
+    with conf._client_lock:
+        if conf._watch_hub is None:
+            conf._watch_hub = _WatchHub(conf)
+        return conf._watch_hub
+
+
+class Cache(object):
+    """An in-process copy of all service records, kept current by a single
+    etcd watch, that answers get_many() queries without contacting etcd.
+
+    Queries are answered from secondary indexes by region, type, host and
+    status kept alongside the records. Results may trail etcd by the time it
+    takes a watch event to arrive, so a Cache suits callers that issue many
+    queries and do not need strictly fresh answers. If the watch ends without
+    close() being called, queries fall back to get_many().
+
+    :param conf: `os_lively.conf.Conf` object representing etcd connection
+                 info and other configuration options
+    """
+
+    _INDEXED_FIELDS = ('region', 'type', 'host', 'status')
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.prefix = _key_by_uuid(conf, '')
+        self.lock = threading.Lock()
+        # Maps service UUID to a tuple of (service record, mod revision)
+        self.services = {}
+        # Maps each indexed field name to a dict of field value -> set of
+        # UUIDs of the services with that value
+        self.indexes = dict((f, {}) for f in self._INDEXED_FIELDS)
+        self.watching = True
+
+        client = _etcd_client(conf)
+        # The watch is started before the records are loaded so that no
+        # change made in between is missed. Events for changes older than
+        # the loaded records are skipped by comparing revisions.
+        events, self.cancel_watch = client.watch_prefix(self.prefix)
+        try:
+            with self.lock:
+                for val, meta in client.get_prefix(self.prefix):
+                    self._put(Service.FromString(val), meta.mod_revision)
+        except Exception:
+            self.cancel_watch()
+            raise
+        t = threading.Thread(
+            name='os-lively-cache',
+            target=self._dispatch,
+            args=(events,),
+        )
+        t.daemon = True
+        t.start()
+
+    def close(self):
+        """Stops keeping the cache current."""
+        self.watching = False
+        self.cancel_watch()
+
+    def get_many(self, **filters):
+        """Returns a list of the cached service records matching the supplied
+        filters, which are the same as get_many()'s.
+        """
+        if not self.watching:
+            return list(get_many(self.conf, **filters))
+
+        with self.lock:
+            uuids = None
+            uuid_filter = _filter_values(filters, 'uuid')
+            if uuid_filter:
+                uuids = set(uuid_filter)
+            for field in self._INDEXED_FIELDS:
+                values = _filter_values(filters, field)
+                if not values:
+                    continue
+                index = self.indexes[field]
+                matches = set()
+                for value in values:
+                    matches.update(index.get(value, ()))
+                uuids = matches if uuids is None else uuids & matches
+            if uuids is None:
+                uuids = self.services
+            services = self.services
+            records = [services[u][0] for u in uuids if u in services]
+
+        # Hand out copies, so that callers cannot modify the cached records
+        results = []
+        for s in records:
+            copy = Service()
+            copy.CopyFrom(s)
+            results.append(copy)
+        return results
+
+    def _put(self, s, revision):
+        cached = self.services.get(s.uuid)
+        if cached is not None:
+            if cached[1] >= revision:
+                return
+            self._unindex(cached[0])
+        self.services[s.uuid] = (s, revision)
+        for field in self._INDEXED_FIELDS:
+            index = self.indexes[field]
+            index.setdefault(getattr(s, field), set()).add(s.uuid)
+
+    def _delete(self, uuid, revision):
+        cached = self.services.get(uuid)
+        if cached is not None and cached[1] < revision:
+            del self.services[uuid]
+            self._unindex(cached[0])
+
+    def _unindex(self, s):
+        for field in self._INDEXED_FIELDS:
+            index = self.indexes[field]
+            value = getattr(s, field)
+            uuids = index.get(value)
+            if uuids is not None:
+                uuids.discard(s.uuid)
+                if not uuids:
+                    del index[value]
+
+    def _dispatch(self, events):
+        prefix_len = len(self.prefix)
+        try:
+            for event in events:
+                with self.lock:
+                    if isinstance(event, etcd3.events.DeleteEvent):
+                        uuid = _to_str(event.key)[prefix_len:]
+                        self._delete(uuid, event.mod_revision)
+                    else:
+                        s = Service.FromString(event.value)
+                        self._put(s, event.mod_revision)
+        finally:
+            self.watching = False
@@ -24,9 +24,15 @@ class TestCase(testtools.TestCase):
 
     def setUp(self):
         super(TestCase, self).setUp()
-        self.cfg = conf.Conf(
-            debug=bool(os.environ.get('OSLIVELY_TEST_DEBUG', True)),
+        self.cfg = conf.Conf(**self.conf_overrides())
+
+    @classmethod
+    def conf_overrides(cls):
+        """Returns the options the test's `conf.Conf` is constructed with."""
+        debug = os.environ.get('OSLIVELY_TEST_DEBUG', 'true')
+        return dict(
+            debug=debug.lower() in ('1', 'true', 'yes'),
             etcd_host=os.environ.get('OSLIVELY_TEST_ETCD_HOST', 'localhost'),
-            etcd_port=os.environ.get('OSLIVELY_TEST_ETCD_PORT', 2379),
+            etcd_port=int(os.environ.get('OSLIVELY_TEST_ETCD_PORT', 2379)),
             status_ttl=60,
         )
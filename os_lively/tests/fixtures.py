@@ -14,60 +14,85 @@
 
 from __future__ import absolute_import
 
+import binascii
+import os
 import pprint
-import random
 
+import etcd3
 import fixtures
 from testtools import content
 from testtools import content_type
 
-from os_lively.tests.functional import curl
-
 
 class EtcdTestEnvironment(fixtures.Fixture):
     """A fixture that uses an etcd key namespace and cleans up after itself."""
 
-    def __init__(self, cfg):
+    def __init__(self, cfg, client=None):
+        """
+        :param cfg: `os_lively.conf.Conf` object to set the namespace on
+        :param client: Optional etcd3 client to use. If not supplied, one is
+                       created and closed when the fixture is cleaned up.
+        """
         super(EtcdTestEnvironment, self).__init__()
-        test_namespace = '/' + ''.join(
-            random.choice('0123456789abcedf') for i in range(8)
-        )
+        self._client = client
+        test_namespace = '/' + binascii.hexlify(os.urandom(4)).decode('ascii')
         self.cfg = cfg
         self.cfg.etcd_key_namespace = test_namespace
 
     def setUp(self):
         super(EtcdTestEnvironment, self).setUp()
-        self.curl_log = []
+        self.etcd_log = []
+        self.client = self._client
+        if self.client is None:
+            self.client = etcd3.client(
+                host=self.cfg.etcd_host,
+                port=self.cfg.etcd_port,
+            )
+            self.addCleanup(self.client.close)
         self.addDetail(
-            'etcd-curl',
+            'etcd-calls',
             content.Content(
                 content_type.UTF8_TEXT,
-                self._get_curl_calls,
+                self._get_etcd_calls,
             ),
         )
-        self.addCleanup(self.curl_delete, '/')
+        self.addCleanup(self.delete, '/')
+        self.addCleanup(self.cfg.close)
 
-    def _get_curl_calls(self):
-        for cmd, out in self.curl_log:
-            yield '\n>> ' + ' '.join(cmd) + '\n<< '
-            if type(out) is unicode:
-                yield out.encode('utf8')
-            else:
-                yield '\n' + pprint.pformat(out)
+    def _get_etcd_calls(self):
+        for call, out in self.etcd_log:
+            yield ('\n>> ' + call + '\n<< ').encode('utf8')
+            yield pprint.pformat(out).encode('utf8')
 
-    def curl_delete(self, key, skip_namespace=False):
-        return curl.delete(
-            self.cfg,
-            key,
-            curl_log=self.curl_log,
-            skip_namespace=skip_namespace,
-        )
+    def _key(self, key):
+        return self.cfg.etcd_key_namespace + '/' + key.lstrip('/')
 
-    def curl_get(self, key):
-        return curl.get(self.cfg, key, curl_log=self.curl_log)
+    def delete(self, key, skip_namespace=False):
+        """Deletes all keys starting with the supplied key, which is relative
+        to the test namespace unless skip_namespace is True.
+        """
+        if not skip_namespace:
+            key = self._key(key)
+        out = self.client.delete_prefix(key)
+        self.etcd_log.append(('delete_prefix(%r)' % key, out))
 
-    def curl_get_prefix(self, prefix):
-        return curl.get_prefix(self.cfg, prefix, curl_log=self.curl_log)
+    def get(self, key):
+        key = self._key(key)
+        out = self.client.get(key)[0]
+        self.etcd_log.append(('get(%r)' % key, out))
+        return out
+
+    def get_prefix(self, prefix):
+        prefix = self._key(prefix)
+        ns_len = len(self.cfg.etcd_key_namespace) + 1
+        out = dict(
+            (meta.key[ns_len:], val)
+            for val, meta in self.client.get_prefix(prefix)
+        )
+        self.etcd_log.append(('get_prefix(%r)' % prefix, out))
+        return out
 
-    def curl_get_all(self):
-        return curl.get_all(self.cfg, curl_log=self.curl_log)
+    def get_all(self):
+        out = dict((meta.key, val) for val, meta in self.client.get_all())
+        self.etcd_log.append(('get_all()', out))
+        return out
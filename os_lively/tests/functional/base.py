@@ -12,6 +12,8 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import etcd3
+
 from os_lively.tests import base
 from os_lively.tests import fixtures
 
@@ -19,6 +21,43 @@ from os_lively.tests import fixtures
 class TestCase(base.TestCase):
 
     """Test case base class for all functional tests."""
+
+    # etcd3 client shared by all the tests in a class, so that each test does
+    # not have to open a new connection to etcd
+    _etcd_client = None
+    # `fixtures.EtcdTestEnvironment` set up by classes that seed etcd once in
+    # setUpClass(). Their tests share its namespace instead of each using a
+    # fresh one.
+    class_etcd = None
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls._etcd_client is not None:
+            cls._etcd_client.close()
+            cls._etcd_client = None
+        super(TestCase, cls).tearDownClass()
+
     def setUp(self):
         super(TestCase, self).setUp()
-        self.etcd = self.useFixture(fixtures.EtcdTestEnvironment(self.cfg))
+        if self.class_etcd is not None:
+            # Each test still gets its own Conf, and with it empty caches
+            ns = self.class_etcd.cfg.etcd_key_namespace
+            self.cfg.etcd_key_namespace = ns
+            self.etcd = self.class_etcd
+            self.addCleanup(self.cfg.close)
+            return
+        self.etcd = self.useFixture(fixtures.EtcdTestEnvironment(
+            self.cfg,
+            client=self._etcd_client,
+        ))
+
+    @classmethod
+    def conf_overrides(cls):
+        overrides = super(TestCase, cls).conf_overrides()
+        if cls._etcd_client is None:
+            cls._etcd_client = etcd3.client(
+                host=overrides['etcd_host'],
+                port=overrides['etcd_port'],
+            )
+        overrides['etcd_client'] = cls._etcd_client
+        return overrides
@@ -24,25 +24,25 @@ cfg = conf.Conf(etcd_host=os.environ.get('OSLIVELY_TEST_ETCD_HOST'))
 
 # Create a couple service records
 
-s1 = service.Service()
-s1.uuid = "3b059e33bbc44bc8b0d37df6e8d70223"
-s1.status = service.Status.UP
-s1.type = 'nova-conductor'
-s1.host = 'otherhost'
-s1.region = 'us-west'
+s1 = service.Service(
+    uuid="3b059e33bbc44bc8b0d37df6e8d70223",
+    status=service.Status.UP,
+    type='nova-conductor',
+    host='otherhost',
+    region='us-west',
+)
 
 service.update(cfg, s1)
 
-s2 = service.Service()
-s2.uuid = "de541c29ec5449e9ab9cea9d938e395c"
-s2.status = service.Status.DOWN
-s2.type = 'nova-compute'
-s2.host = 'localhost'
-s2.region = 'us-east'
-s2.maintenance_note = 'Failed disk /dev/sda'
-maint_time = datetime.datetime.utcnow()
-maint_time = int(time.mktime(maint_time.timetuple()))
-s2.maintenance_start = maint_time
+s2 = service.Service(
+    uuid="de541c29ec5449e9ab9cea9d938e395c",
+    status=service.Status.DOWN,
+    type='nova-compute',
+    host='localhost',
+    region='us-east',
+    maintenance_note='Failed disk /dev/sda',
+    maintenance_start=int(time.time()),
+)
 
 service.update(cfg, s2)
 
@@ -10,70 +10,127 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from multiprocessing.pool import ThreadPool
 import random
 import threading
-import time
 import uuid
 
+from os_lively import conf
 from os_lively import service
+from os_lively.tests import fixtures
 from os_lively.tests.functional import base
 
+# Compute node hostnames, by rack, of the simulated deployment
+_RACK_HOSTS = tuple(
+    tuple('r%d-c%d' % (rack_id, cn_id) for cn_id in range(20))
+    for rack_id in range(5)
+)
+
 
 class NotifyBaseTest(base.TestCase):
 
-    def setUp(self):
-        super(NotifyBaseTest, self).setUp()
+    @classmethod
+    def setUpClass(cls):
+        super(NotifyBaseTest, cls).setUpClass()
+        # The services are seeded once, into an etcd namespace shared by all
+        # the tests in the class. Tests should not rely on the status an
+        # earlier test left a service in.
+        class_cfg = conf.Conf(**cls.conf_overrides())
+        class_etcd = fixtures.EtcdTestEnvironment(
+            class_cfg,
+            client=cls._etcd_client,
+        )
+        class_etcd.setUp()
+        try:
+            cls._seed_services(class_cfg)
+        except Exception:
+            class_etcd.cleanUp()
+            raise
+        cls.class_etcd = class_etcd
+
+    @classmethod
+    def tearDownClass(cls):
+        # Deletes the whole namespace, and with it every seeded key
+        cls.class_etcd.cleanUp()
+        cls.class_etcd = None
+        super(NotifyBaseTest, cls).tearDownClass()
+
+    @classmethod
+    def _seed_services(cls, cfg):
         # Simulate a set of 100 of compute nodes in 5 racks,, each with a
         # nova-compute service in an UP state.
+        rack_batches = []
         service_uuids = []
         host_services = {}
         rack_services = {}
-        for rack_id in range(5):
+        for rack_id, hosts in enumerate(_RACK_HOSTS):
             rack_services[rack_id] = []
-            for cn_id in range(20):
+            services = []
+            for host in hosts:
                 service_uuid = uuid.uuid4().hex
                 service_uuids.append(service_uuid)
-                host = 'r%d-c%d' % (rack_id, cn_id)
-                s = service.Service()
-                s.uuid = service_uuid
-                s.type = 'nova-compute'
-                s.host = host
-                s.region = 'us-east'
-                s.status = service.Status.UP
-                service.update(self.cfg, s)
+                s = service.Service(
+                    uuid=service_uuid,
+                    type='nova-compute',
+                    host=host,
+                    region='us-east',
+                    status=service.Status.UP,
+                )
+                services.append(s)
                 host_services[host] = service_uuid
                 rack_services[rack_id].append(service_uuid)
+            rack_batches.append(services)
+
+        # Register each rack's services concurrently over the shared client
+        pool = ThreadPool(len(rack_batches))
+        try:
+            pool.map(
+                lambda services: service.update_many(cfg, services),
+                rack_batches,
+            )
+        finally:
+            pool.close()
+            pool.join()
 
-        self.service_uuids = service_uuids
-        self.host_services = host_services
-        self.rack_services = {}
+        cls.service_uuids = service_uuids
+        cls.host_services = host_services
+        cls.rack_services = {}
 
 
 class ThreadingNotifyTest(NotifyBaseTest):
 
     def test_notify(self):
-        flapper = random.choice(self.service_uuids)
+        uuids = self.service_uuids
+        flapper = uuids[random.randrange(len(uuids))]
+
+        # Each status change is made only once the previous one has been
+        # seen by the watcher, rather than after a fixed sleep
+        seen = threading.Semaphore(0)
 
         def down_up_down():
             service.down(self.cfg, uuid=flapper)
-            time.sleep(1)
+            seen.acquire()
             s = service.get_one(self.cfg, uuid=flapper)
             s.status = service.Status.UP
             service.update(self.cfg, s)
-            time.sleep(1)
+            seen.acquire()
             service.down(self.cfg, uuid=flapper)
 
+        # Start watching before the flapper makes its first change
+        notify = service.notify(self.cfg, uuid=flapper)
         t = threading.Thread(name='flapper', target=down_up_down)
         t.start()
 
-        notify = service.notify(self.cfg, uuid=flapper)
         count = 0
         status_changes = []
+        # ParseFromString() clears the message first, so one is reused for
+        # every event
+        s = service.Service()
         for event in notify.events:
             count += 1
-            s = service.Service()
             s.ParseFromString(event.value)
             status_changes.append(service.status_itoa(s.status))
+            seen.release()
             if count > 2:
                 notify.cancel()
 
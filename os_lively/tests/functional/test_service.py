@@ -10,15 +10,31 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import time
 import uuid
 
+import etcd3
+from etcd3 import etcdrpc
+from testtools import matchers
+
 from os_lively import service
 from os_lively.tests.functional import base
 
 
 class ServiceTestCase(base.TestCase):
 
+    def _svc_has_uuid(self, uuid_, **filters):
+        return any(
+            s.uuid == uuid_ for s in service.get_many(self.cfg, **filters)
+        )
+
+    def _check_filter_cases(self, uuid_, cases):
+        for filters, expected in cases:
+            self.expectThat(
+                self._svc_has_uuid(uuid_, **filters),
+                matchers.Is(expected),
+                'get_many(%r)' % filters,
+            )
+
     def test_smoke(self):
         service_uuid = uuid.uuid4().hex
 
@@ -33,12 +49,13 @@ class ServiceTestCase(base.TestCase):
 
         # Create the service record in an UP status and validate that the
         # service is found and in an UP state
-        svc = service.Service()
-        svc.uuid = service_uuid
-        svc.host = 'localhost'
-        svc.type = 'nova-compute'
-        svc.region = 'us-east'
-        svc.status = service.Status.UP
+        svc = service.Service(
+            uuid=service_uuid,
+            host='localhost',
+            type='nova-compute',
+            region='us-east',
+            status=service.Status.UP,
+        )
         service.update(self.cfg, svc)
 
         self.assertTrue(
@@ -65,57 +82,29 @@ class ServiceTestCase(base.TestCase):
         )
 
         # Get a list of all the services in the system and ensure our service
-        # is in there
-        services = service.get_many(self.cfg)
-        service_uuids = [s.uuid for s in services]
-        self.assertIn(service_uuid, service_uuids)
-
-        # Try filtering by wrong region
-        services = service.get_many(self.cfg, region='us-west')
-        service_uuids = [s.uuid for s in services]
-        self.assertNotIn(service_uuid, service_uuids)
-
-        # Try filtering by a right region
-        services = service.get_many(self.cfg, region='us-east')
-        service_uuids = [s.uuid for s in services]
-        self.assertIn(service_uuid, service_uuids)
+        # is in there, then check that each filter includes or excludes it.
+        # expectThat() records a failed case and carries on, so one run
+        # reports every filter that is broken.
+        cases = (
+            ({}, True),
+            ({'region': 'us-west'}, False),
+            ({'region': 'us-east'}, True),
+        )
+        self._check_filter_cases(service_uuid, cases)
 
         # Update region and check again
         res.region = 'us-west'
         service.update(self.cfg, res)
-        services = service.get_many(self.cfg, region='us-west')
-        service_uuids = [s.uuid for s in services]
-        self.assertIn(service_uuid, service_uuids)
-
-        # Try filtering by wrong type
-        services = service.get_many(self.cfg, type='nova-conductor')
-        service_uuids = [s.uuid for s in services]
-        self.assertNotIn(service_uuid, service_uuids)
-
-        # Try filtering by a right type
-        services = service.get_many(self.cfg, type='nova-compute')
-        service_uuids = [s.uuid for s in services]
-        self.assertIn(service_uuid, service_uuids)
-
-        # Try filtering by wrong status
-        services = service.get_many(self.cfg, status=service.Status.UP)
-        service_uuids = [s.uuid for s in services]
-        self.assertNotIn(service_uuid, service_uuids)
-
-        # Try filtering by a right status
-        services = service.get_many(self.cfg, status=service.Status.DOWN)
-        service_uuids = [s.uuid for s in services]
-        self.assertIn(service_uuid, service_uuids)
-
-        # Try filtering by wrong host
-        services = service.get_many(self.cfg, host='otherhost')
-        service_uuids = [s.uuid for s in services]
-        self.assertNotIn(service_uuid, service_uuids)
-
-        # Try filtering by a right host
-        services = service.get_many(self.cfg, host='localhost')
-        service_uuids = [s.uuid for s in services]
-        self.assertIn(service_uuid, service_uuids)
+        cases = (
+            ({'region': 'us-west'}, True),
+            ({'type': 'nova-conductor'}, False),
+            ({'type': 'nova-compute'}, True),
+            ({'status': service.Status.UP}, False),
+            ({'status': service.Status.DOWN}, True),
+            ({'host': 'otherhost'}, False),
+            ({'host': 'localhost'}, True),
+        )
+        self._check_filter_cases(service_uuid, cases)
 
         # Set the service back into an UP state after setting a short TTL.
         # Check the service is UP immediately after and then not UP after the
@@ -132,7 +121,17 @@ class ServiceTestCase(base.TestCase):
         self.assertTrue(
             service.is_up(self.cfg, uuid=service_uuid)
         )
-        time.sleep(new_ttl + 1)
+        # Rather than sleeping for longer than the TTL, wait for etcd to
+        # delete the UP status key when the lease expires
+        up_key = service._key_by_status(
+            self.cfg, service.Status.UP, service_uuid,
+        )
+        event = self.etcd.client.watch_once(
+            up_key,
+            timeout=new_ttl + 2,
+            filters=[etcdrpc.WatchCreateRequest.NOPUT],
+        )
+        self.assertIsInstance(event, etcd3.events.DeleteEvent)
         self.assertFalse(
             service.is_up(self.cfg, uuid=service_uuid)
         )
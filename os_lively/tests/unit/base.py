@@ -22,5 +22,5 @@ class TestCase(base.TestCase):
 
     def setUp(self):
         super(TestCase, self).setUp()
-        etcd_mock = mock.patch('etcd3.client').start()
-        self.etcd = etcd_mock.return_value
+        self.etcd_client = mock.patch('etcd3.client').start()
+        self.etcd = self.etcd_client.return_value
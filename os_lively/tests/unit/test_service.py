@@ -10,15 +10,38 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
+import os
+import threading
+import time
 import uuid
 
+import etcd3
 import mock
+from six.moves import queue
 
+from os_lively import conf
 from os_lively import service
 from os_lively.tests.unit import base
 
 
+class _UTCPlus2(datetime.tzinfo):
+    def utcoffset(self, dt):
+        return datetime.timedelta(hours=2)
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+
+_UTC_PLUS_2 = _UTCPlus2()
+
+
 class ServiceTestCase(base.TestCase):
+    # Responses from etcd3.Etcd3Client.get() for a found status key and for a
+    # missing key
+    _UP_RESP = (1, mock.sentinel.meta)
+    _NOT_FOUND = (None, None)
+
     def setUp(self):
         super(ServiceTestCase, self).setUp()
         self.uuid = uuid.uuid4().hex
@@ -31,31 +54,38 @@ class ServiceTestCase(base.TestCase):
         )
 
     def test_service_is_up_uuid_up(self):
-        self.etcd.get.return_value = (1, mock.sentinel.meta)
+        self.etcd.get.return_value = self._UP_RESP
         self.assertTrue(service.is_up(self.cfg, uuid=self.uuid))
         uri = "/services/by-status/UP/" + self.uuid
-        self.etcd.get.assert_called_once_with(uri)
+        self.etcd.get.assert_called_once_with(uri, serializable=True)
 
     def test_service_is_up_uuid_down(self):
-        self.etcd.get.return_value = (None, None)
+        self.etcd.get.return_value = self._NOT_FOUND
         self.assertFalse(service.is_up(self.cfg, uuid=self.uuid))
         uri = "/services/by-status/UP/" + self.uuid
-        self.etcd.get.assert_called_once_with(uri)
+        self.etcd.get.assert_called_once_with(uri, serializable=True)
+
+    def test_service_is_up_key_namespace(self):
+        self.cfg.etcd_key_namespace = '/oslively-ns'
+        self.etcd.get.return_value = self._UP_RESP
+        self.assertTrue(service.is_up(self.cfg, uuid=self.uuid))
+        uri = "/oslively-ns/services/by-status/UP/" + self.uuid
+        self.etcd.get.assert_called_once_with(uri, serializable=True)
 
     def test_service_is_up_type_host_exist_up(self):
         self.etcd.get.side_effect = [
             # The request to get the UUID of the service matching host and type
             (self.uuid, mock.sentinel.meta),
             # The request to see if the UUID is in UP status
-            (1, mock.sentinel.meta),
+            self._UP_RESP,
         ]
         res = service.is_up(self.cfg, type='nova-compute', host='localhost')
         self.assertTrue(res)
         type_host_uri = "/services/by-type-host/nova-compute/localhost"
         status_uri = "/services/by-status/UP/" + self.uuid
         self.etcd.get.assert_has_calls([
-            mock.call(type_host_uri),
-            mock.call(status_uri),
+            mock.call(type_host_uri, serializable=True),
+            mock.call(status_uri, serializable=True),
         ])
 
     def test_service_is_up_type_host_exist_down(self):
@@ -63,26 +93,799 @@ class ServiceTestCase(base.TestCase):
             # The request to get the UUID of the service matching host and type
             (self.uuid, mock.sentinel.meta),
             # The request to see if the UUID is in UP status
-            (None, None),  # Not Found
+            self._NOT_FOUND,
         ]
         res = service.is_up(self.cfg, type='nova-compute', host='localhost')
         self.assertFalse(res)
         type_host_uri = "/services/by-type-host/nova-compute/localhost"
         status_uri = "/services/by-status/UP/" + self.uuid
         self.etcd.get.assert_has_calls([
-            mock.call(type_host_uri),
-            mock.call(status_uri),
+            mock.call(type_host_uri, serializable=True),
+            mock.call(status_uri, serializable=True),
         ])
 
     def test_service_is_up_type_host_not_exist(self):
         self.etcd.get.side_effect = [
             # The request to get the UUID of the service matching host and type
-            (None, None),  # Not Found
+            self._NOT_FOUND,
         ]
         res = service.is_up(self.cfg, type='nova-compute', host='localhost')
         self.assertFalse(res)
         type_host_uri = "/services/by-type-host/nova-compute/localhost"
-        self.etcd.get.assert_called_once_with(type_host_uri)
+        self.etcd.get.assert_called_once_with(
+            type_host_uri, serializable=True,
+        )
+
+    def test_service_is_up_read_cache(self):
+        self.etcd.get.return_value = self._UP_RESP
+        self.assertTrue(service.is_up(self.cfg, uuid=self.uuid))
+        self.assertTrue(service.is_up(self.cfg, uuid=self.uuid))
+        uri = "/services/by-status/UP/" + self.uuid
+        self.etcd.get.assert_called_once_with(uri, serializable=True)
+
+        # Expired entries go back to etcd
+        self.cfg._is_up_cache[self.uuid] = (0, True)
+        self.etcd.get.return_value = self._NOT_FOUND
+        self.assertFalse(service.is_up(self.cfg, uuid=self.uuid))
+        self.assertEqual(2, self.etcd.get.call_count)
+
+    def test_service_is_up_read_cache_disabled(self):
+        self.cfg.read_cache_ttl = 0
+        self.etcd.get.return_value = self._UP_RESP
+        self.assertTrue(service.is_up(self.cfg, uuid=self.uuid))
+        self.assertTrue(service.is_up(self.cfg, uuid=self.uuid))
+        self.assertEqual(2, self.etcd.get.call_count)
+        self.assertEqual({}, self.cfg._is_up_cache)
+
+    def test_service_is_up_type_host_uuid_cached(self):
+        self.etcd.get.side_effect = [
+            # The request to get the UUID of the service matching host and type
+            (self.uuid, mock.sentinel.meta),
+            # The request to see if the UUID is in UP status
+            self._UP_RESP,
+            # The second is_up() goes straight to the UP status check
+            self._UP_RESP,
+        ]
+        for x in range(2):
+            res = service.is_up(
+                self.cfg, type='nova-compute', host='localhost',
+            )
+            self.assertTrue(res)
+            # Only the UUID is remembered, not the status
+            self.cfg._is_up_cache.clear()
+        type_host_uri = "/services/by-type-host/nova-compute/localhost"
+        status_uri = "/services/by-status/UP/" + self.uuid
+        self.assertEqual(
+            [
+                mock.call(type_host_uri, serializable=True),
+                mock.call(status_uri, serializable=True),
+                mock.call(status_uri, serializable=True),
+            ],
+            self.etcd.get.call_args_list,
+        )
+
+    def test_service_is_up_type_host_cached_uuid_stale(self):
+        other_uuid = uuid.uuid4().hex
+        self.cfg._uuid_cache[('nova-compute', 'localhost')] = (
+            time.time() + 60, other_uuid,
+        )
+        self.etcd.get.side_effect = [
+            # The remembered service is no longer UP...
+            self._NOT_FOUND,
+            # ...because the type and host now belong to another service
+            (self.uuid, mock.sentinel.meta),
+            self._UP_RESP,
+        ]
+        res = service.is_up(self.cfg, type='nova-compute', host='localhost')
+        self.assertTrue(res)
+        self.assertEqual(
+            self.uuid,
+            self.cfg._uuid_cache[('nova-compute', 'localhost')][1],
+        )
+
+    def test_service_is_up_type_host_cached_uuid_expired(self):
+        # The remembered service may have moved to another host since, so an
+        # expired entry is not trusted even if that service is UP
+        other_uuid = uuid.uuid4().hex
+        self.cfg._uuid_cache[('nova-compute', 'localhost')] = (0, other_uuid)
+        self.etcd.get.side_effect = [
+            (self.uuid, mock.sentinel.meta),
+            self._NOT_FOUND,
+        ]
+        res = service.is_up(self.cfg, type='nova-compute', host='localhost')
+        self.assertFalse(res)
+        status_uri = "/services/by-status/UP/" + self.uuid
+        self.etcd.get.assert_called_with(status_uri, serializable=True)
+
+    def test_service_is_up_type_host_cache_disabled(self):
+        self.cfg.read_cache_ttl = 0
+        self.etcd.get.side_effect = [
+            (self.uuid, mock.sentinel.meta),
+            self._UP_RESP,
+        ]
+        res = service.is_up(self.cfg, type='nova-compute', host='localhost')
+        self.assertTrue(res)
+        self.assertEqual({}, self.cfg._uuid_cache)
+
+    def test_notify_shares_watch(self):
+        feed = queue.Queue()
+        cancel_watch = mock.Mock()
+        self.etcd.watch_prefix.return_value = (iter(feed.get, None),
+                                               cancel_watch)
+        n1 = service.notify(self.cfg, uuid=self.uuid)
+        n2 = service.notify(self.cfg, uuid=self.uuid)
+        self.etcd.watch_prefix.assert_called_once_with(
+            '/services/by-uuid/', prev_kv=True,
+        )
+
+        prefix = b'/services/by-uuid/'
+        event = mock.Mock(key=prefix + self.uuid.encode())
+        other = mock.Mock(key=prefix + uuid.uuid4().hex.encode())
+        feed.put(other)
+        feed.put(event)
+        self.assertIs(event, next(n1.events))
+        self.assertIs(event, next(n2.events))
+
+        n1.cancel()
+        self.assertEqual([], list(n1.events))
+        self.assertFalse(cancel_watch.called)
+        n2.cancel()
+        cancel_watch.assert_called_once_with()
+        feed.put(None)
+
+    def test_notify_filters(self):
+        feed = queue.Queue()
+        self.etcd.watch_prefix.return_value = (iter(feed.get, None),
+                                               mock.Mock())
+        n = service.notify(self.cfg, region='us-east',
+                           status=[service.Status.UP])
+        self.assertFalse(self.etcd.get.called)
+
+        prefix = b'/services/by-uuid/'
+        other_svc = self._service()
+        other_svc.uuid = uuid.uuid4().hex
+        other_svc.region = 'us-west'
+        other = mock.Mock(key=prefix + other_svc.uuid.encode(),
+                          value=other_svc.SerializeToString(),
+                          prev_value=b'')
+        svc = self._service()
+        event = mock.Mock(key=prefix + svc.uuid.encode(),
+                          value=svc.SerializeToString(),
+                          prev_value=b'')
+        feed.put(other)
+        feed.put(event)
+        self.assertIs(event, next(n.events))
+
+        # A service leaving the filters, here by going DOWN, is seen too...
+        down_svc = self._service()
+        down_svc.status = service.Status.DOWN
+        down = mock.Mock(key=event.key,
+                         value=down_svc.SerializeToString(),
+                         prev_value=event.value)
+        # ...but not one that matched neither before nor after the change
+        other_down_svc = service.Service()
+        other_down_svc.CopyFrom(other_svc)
+        other_down_svc.status = service.Status.DOWN
+        other_down = mock.Mock(key=other.key,
+                               value=other_down_svc.SerializeToString(),
+                               prev_value=other.value)
+        feed.put(other_down)
+        feed.put(down)
+        self.assertIs(down, next(n.events))
+
+        # Deletions carry no value and are matched on the deleted record
+        other_deleted = mock.Mock(
+            spec=etcd3.events.DeleteEvent,
+            key=other.key,
+            value=b'',
+            prev_value=other.value,
+        )
+        deleted = mock.Mock(
+            spec=etcd3.events.DeleteEvent,
+            key=event.key,
+            value=b'',
+            prev_value=event.value,
+        )
+        feed.put(other_deleted)
+        feed.put(deleted)
+        self.assertIs(deleted, next(n.events))
+
+        n.cancel()
+        self.assertEqual([], list(n.events))
+        feed.put(None)
+
+    def test_get_status(self):
+        self.etcd.transaction.return_value = (
+            True, [[], [(b'', mock.sentinel.meta)]],
+        )
+        res = service.get_status(self.cfg, uuid=self.uuid)
+        self.assertEqual(service.Status.DOWN, res)
+        self.assertFalse(self.etcd.get.called)
+        self.etcd.transactions.get.assert_has_calls([
+            mock.call("/services/by-status/UP/" + self.uuid),
+            mock.call("/services/by-status/DOWN/" + self.uuid),
+        ])
+
+        self.etcd.transaction.return_value = (True, [[], []])
+        self.assertIsNone(service.get_status(self.cfg, uuid=self.uuid))
+
+    def test_cache(self):
+        feed = queue.Queue()
+        self.etcd.watch_prefix.return_value = (iter(feed.get, None),
+                                               mock.Mock())
+        s = self._service()
+        self.etcd.get_prefix.return_value = [
+            (s.SerializeToString(), mock.Mock(mod_revision=3)),
+        ]
+        cache = service.Cache(self.cfg)
+        self.addCleanup(cache.close)
+        self.etcd.watch_prefix.assert_called_once_with('/services/by-uuid/')
+
+        self.assertEqual([s], cache.get_many(region='us-east'))
+        self.assertEqual([], cache.get_many(region='us-west'))
+
+        # A stale event from before the records were loaded is ignored...
+        stale = self._service()
+        stale.region = 'us-central'
+        feed.put(mock.Mock(value=stale.SerializeToString(), mod_revision=2))
+        # ...while a newer one moves the record to its new region
+        moved = self._service()
+        moved.region = 'us-west'
+        feed.put(mock.Mock(value=moved.SerializeToString(), mod_revision=4))
+        for x in range(100):
+            if cache.get_many(region='us-west'):
+                break
+            time.sleep(0.01)
+        self.assertEqual([moved], cache.get_many(region='us-west'))
+        self.assertEqual([], cache.get_many(region='us-east'))
+        self.assertEqual([], cache.get_many(region='us-central'))
+        self.assertEqual([moved], cache.get_many(type='nova-compute'))
+
+        # Deleting the record drops it from every index
+        deleted = mock.Mock(
+            spec=etcd3.events.DeleteEvent,
+            key=('/services/by-uuid/' + self.uuid).encode(),
+            mod_revision=5,
+        )
+        feed.put(deleted)
+        for x in range(100):
+            if not cache.get_many():
+                break
+            time.sleep(0.01)
+        self.assertEqual([], cache.get_many(region='us-east'))
+        self.assertEqual([], cache.get_many(region='us-west'))
+        self.assertFalse(self.etcd.transaction.called)
+        feed.put(None)
+
+    def test_cache_load_fails(self):
+        cancel_watch = mock.Mock()
+        self.etcd.watch_prefix.return_value = (iter(()), cancel_watch)
+        exc = etcd3.exceptions.ConnectionFailedError
+        self.etcd.get_prefix.side_effect = exc
+        self.assertRaises(
+            exc,
+            service.Cache,
+            self.cfg,
+        )
+        cancel_watch.assert_called_once_with()
+
+    def test_is_up_many(self):
+        up_uuid = self.uuid
+        down_uuid = uuid.uuid4().hex
+        type_prefix = '/services/by-type-host/nova-compute/'
+        up_prefix = '/services/by-status/UP/'
+
+        def kv(key, val):
+            return val.encode(), mock.Mock(key=key.encode())
+
+        self.etcd.get_prefix.side_effect = [
+            [
+                kv(type_prefix + 'h1', up_uuid),
+                kv(type_prefix + 'h2', down_uuid),
+            ],
+            [
+                kv(up_prefix + up_uuid, ''),
+            ],
+        ]
+        res = service.is_up_many(self.cfg, 'nova-compute', ['h1', 'h2', 'h3'])
+        self.assertEqual({'h1': True, 'h2': False, 'h3': False}, res)
+        self.etcd.get_prefix.assert_has_calls([
+            mock.call(type_prefix),
+            mock.call(up_prefix),
+        ])
+        self.assertFalse(self.etcd.get.called)
+
+    def test_is_up_many_uuids(self):
+        down_uuid = uuid.uuid4().hex
+        self.etcd.transaction.return_value = (
+            True, [[(b'', mock.sentinel.meta)], []],
+        )
+        res = service.is_up_many(self.cfg, uuids=[self.uuid, down_uuid])
+        self.assertEqual({self.uuid: True, down_uuid: False}, res)
+        self.etcd.transactions.get.assert_has_calls([
+            mock.call("/services/by-status/UP/" + self.uuid),
+            mock.call("/services/by-status/UP/" + down_uuid),
+        ])
+        self.assertEqual(1, self.etcd.transaction.call_count)
+        self.assertFalse(self.etcd.get.called)
+
+    def test_get_many_by_region_index(self):
+        s = self._service()
+        # reindex() has been run
+        self.etcd.get.return_value = (b'1', mock.sentinel.meta)
+        region_prefix = '/services/by-region/us-east/'
+        self.etcd.get_prefix.return_value = [
+            (b'', mock.Mock(key=(region_prefix + self.uuid).encode())),
+        ]
+        self.etcd.transaction.return_value = (
+            True, [[(s.SerializeToString(), mock.sentinel.meta)]],
+        )
+        res = list(service.get_many(self.cfg, region='us-east'))
+        self.assertEqual([s], res)
+        self.etcd.get.assert_called_once_with('/services/region-index-ready')
+        self.etcd.get_prefix.assert_called_once_with(region_prefix)
+        self.etcd.transactions.get.assert_called_once_with(
+            '/services/by-uuid/' + self.uuid,
+        )
+
+    def test_get_many_by_region_not_reindexed(self):
+        s = self._service()
+        # Without reindex() having been run, records created by older
+        # releases may be missing from the index, so all records are scanned
+        self.etcd.get.return_value = self._NOT_FOUND
+        self.etcd.get_prefix.return_value = [
+            (s.SerializeToString(), mock.sentinel.meta),
+        ]
+        for x in range(2):
+            res = list(service.get_many(self.cfg, region='us-east'))
+            self.assertEqual([s], res)
+        self.etcd.get_prefix.assert_called_with('/services/by-uuid/')
+        self.assertEqual(2, self.etcd.get_prefix.call_count)
+        self.assertFalse(self.etcd.transaction.called)
+        # Until the marker is found, it is looked up again on each query
+        self.assertEqual(2, self.etcd.get.call_count)
+
+    def test_reindex(self):
+        s = self._service()
+        self.etcd.get_prefix.side_effect = [
+            [(s.SerializeToString(), mock.sentinel.meta)],
+            [
+                (b'', mock.Mock(key=b'/services/by-region/us-east')),
+                (b'', mock.Mock(key=b'/services/by-region/us-west')),
+                (b'', mock.Mock(key=b'/services/by-region/us-west/x')),
+            ],
+        ]
+        service.reindex(self.cfg)
+        self.etcd.transactions.put.assert_called_once_with(
+            '/services/by-region/us-east/' + self.uuid, value='',
+        )
+        self.etcd.transactions.delete.assert_has_calls([
+            mock.call('/services/by-region/us-east'),
+            mock.call('/services/by-region/us-west'),
+        ])
+        self.assertEqual(2, self.etcd.transactions.delete.call_count)
+        self.assertEqual(1, self.etcd.transaction.call_count)
+        self.etcd.put.assert_called_once_with(
+            '/services/region-index-ready', '1',
+        )
+
+        # The index by region is used from now on, without checking again
+        self.etcd.get_prefix.side_effect = None
+        self.etcd.get_prefix.return_value = []
+        self.assertEqual([], list(service.get_many(self.cfg, region='x')))
+        self.etcd.get_prefix.assert_called_with('/services/by-region/x/')
+        self.assertFalse(self.etcd.get.called)
+
+    def test_get_many_by_uuid_filters_rest(self):
+        s = self._service()
+        self.etcd.transaction.return_value = (
+            True, [[(s.SerializeToString(), mock.sentinel.meta)], []],
+        )
+        res = list(service.get_many(
+            self.cfg,
+            uuid=[self.uuid, uuid.uuid4().hex],
+            region='us-west',
+        ))
+        self.assertEqual([], res)
+        self.assertFalse(self.etcd.get_prefix.called)
+        self.assertEqual(2, self.etcd.transactions.get.call_count)
+
+    def test_get_many_no_index(self):
+        s = self._service()
+        self.etcd.get_prefix.return_value = [
+            (s.SerializeToString(), mock.sentinel.meta),
+        ]
+        res = list(service.get_many(self.cfg, host='localhost'))
+        self.assertEqual([s], res)
+        self.etcd.get_prefix.assert_called_once_with('/services/by-uuid/')
+        self.assertFalse(self.etcd.transaction.called)
+
+    def test_etcd_client_reused(self):
+        self.etcd.get.return_value = self._NOT_FOUND
+        service.is_up(self.cfg, uuid=self.uuid)
+        service.is_up(self.cfg, uuid=self.uuid)
+        self.etcd_client.assert_called_once_with(
+            host=self.cfg.etcd_host,
+            port=self.cfg.etcd_port,
+            timeout=self.cfg.etcd_connect_timeout,
+            grpc_options=[
+                ('grpc.keepalive_time_ms', 10000),
+                ('grpc.keepalive_timeout_ms', 3000),
+                ('grpc.http2.max_pings_without_data', 0),
+            ],
+        )
+
+        self.cfg.close()
+        self.etcd.close.assert_called_once_with()
+        self.assertEqual([], self.cfg._etcd_clients)
+
+    def test_etcd_client_pool(self):
+        self.cfg.etcd_pool_size = 2
+        clients = [mock.Mock(), mock.Mock()]
+        self.etcd_client.side_effect = clients
+        for c in clients:
+            c.get.return_value = self._NOT_FOUND
+        for x in range(4):
+            service.is_up(self.cfg, uuid=uuid.uuid4().hex)
+        self.assertEqual(2, self.etcd_client.call_count)
+        self.assertEqual(2, clients[0].get.call_count)
+        self.assertEqual(2, clients[1].get.call_count)
+
+        self.cfg.close()
+        for c in clients:
+            c.close.assert_called_once_with()
+
+    def test_etcd_client_supplied(self):
+        client = mock.Mock()
+        client.get.return_value = self._NOT_FOUND
+        cfg = conf.Conf(etcd_client=client)
+        service.is_up(cfg, uuid=self.uuid)
+        self.assertFalse(self.etcd_client.called)
+        client.get.assert_called_once_with(
+            "/services/by-status/UP/" + self.uuid, serializable=True,
+        )
+
+        cfg.close()
+        self.assertFalse(client.close.called)
+
+    def test_conf_environment(self):
+        env = {
+            'OSLIVELY_ETCD_PORT': '12379',
+            'OSLIVELY_STATUS_TTL': '30',
+        }
+        # Variables set after the module is imported are still honoured
+        with mock.patch.dict(os.environ, env):
+            cfg = conf.Conf()
+            self.assertEqual(12379, cfg.etcd_port)
+            self.assertEqual(30, cfg.status_ttl)
+            # Overrides take precedence over the environment
+            self.assertEqual(5, conf.Conf(status_ttl=5).status_ttl)
+
+        # A malformed value is reported when the Conf is constructed
+        with mock.patch.dict(os.environ, {'OSLIVELY_ETCD_PORT': 'x'}):
+            self.assertRaises(ValueError, conf.Conf)
+            self.assertEqual(1, conf.Conf(etcd_port=1).etcd_port)
+
+    def _service(self):
+        return service.Service(
+            uuid=self.uuid,
+            type='nova-compute',
+            host='localhost',
+            region='us-east',
+            status=service.Status.UP,
+        )
+
+    def test_update_heartbeat_refreshes_lease(self):
+        s = self._service()
+        self.cfg._is_up_cache[self.uuid] = (time.time() + 60, False)
+        meta = mock.Mock(version=1)
+        self.etcd.get.return_value = (s.SerializeToString(), meta)
+        lease = self.etcd.lease.return_value
+        lease.ttl = self.cfg.status_ttl
+        lease.refresh.return_value = [mock.Mock(TTL=self.cfg.status_ttl)]
+
+        # The first update grants the lease and attaches it to the status key
+        service.update(self.cfg, s)
+        self.etcd.lease.assert_called_once_with(ttl=self.cfg.status_ttl)
+        self.assertEqual(1, self.etcd.transaction.call_count)
+        self.assertNotIn(self.uuid, self.cfg._is_up_cache)
+        status_key = "/services/by-status/UP/" + self.uuid
+        self.etcd.transactions.put.assert_any_call(
+            status_key, value='', lease=lease,
+        )
+
+        # Subsequent heartbeats with no changes only keep the lease alive,
+        # without even reading back the record that was just written
+        res = service.update(self.cfg, s)
+        self.assertEqual((True, lease), res)
+        lease.refresh.assert_called_once_with()
+        self.etcd.get.assert_called_once_with(
+            "/services/by-uuid/" + self.uuid,
+        )
+        self.etcd.lease.assert_called_once_with(ttl=self.cfg.status_ttl)
+        self.assertEqual(1, self.etcd.transaction.call_count)
+
+    def test_update_failed_create_lease_not_cached(self):
+        s = self._service()
+        self.etcd.get.return_value = self._NOT_FOUND
+        lease = self.etcd.lease.return_value
+        lease.ttl = self.cfg.status_ttl
+        lease.refresh.return_value = [mock.Mock(TTL=self.cfg.status_ttl)]
+        # Someone else creates the service before our transaction runs
+        self.etcd.transaction.return_value = (False, [])
+
+        service.update(self.cfg, s)
+        self.assertNotIn(self.uuid, self.cfg._status_leases)
+
+        # The retry grants a new lease and attaches it, rather than keeping
+        # alive the one that was never attached to the status key
+        self.etcd.transaction.return_value = (True, [])
+        service.update(self.cfg, s)
+        self.assertFalse(lease.refresh.called)
+        self.assertEqual(2, self.etcd.lease.call_count)
+        self.assertEqual(2, self.etcd.transaction.call_count)
+        status_key = "/services/by-status/UP/" + self.uuid
+        self.assertEqual(
+            2,
+            self.etcd.transactions.put.call_args_list.count(
+                mock.call(status_key, value='', lease=lease),
+            ),
+        )
+        self.assertIs(lease, self.cfg._status_leases[self.uuid])
+
+    def test_update_changed_skips_read(self):
+        s = self._service()
+        self.cfg._last_written[self.uuid] = (s.SerializeToString(), 3)
+        lease = self.etcd.lease.return_value
+        lease.ttl = self.cfg.status_ttl
+        lease.refresh.return_value = [mock.Mock(TTL=self.cfg.status_ttl)]
+        self.cfg._status_leases[self.uuid] = lease
+        self.etcd.transaction.return_value = (True, [])
+
+        s.status = service.Status.DOWN
+        service.update(self.cfg, s)
+
+        # The change is diffed against the record last written, not read back
+        self.assertFalse(self.etcd.get.called)
+        self.etcd.transactions.delete.assert_called_once_with(
+            "/services/by-status/UP/" + self.uuid,
+        )
+        self.etcd.transactions.get.assert_called_once_with(
+            "/services/by-uuid/" + self.uuid,
+        )
+        self.assertEqual(1, self.etcd.transaction.call_count)
+        self.assertEqual(
+            (s.SerializeToString(), 4),
+            self.cfg._last_written[self.uuid],
+        )
+
+    def test_update_changed_elsewhere(self):
+        s = self._service()
+        self.cfg._last_written[self.uuid] = (s.SerializeToString(), 3)
+        lease = self.etcd.lease.return_value
+        lease.ttl = self.cfg.status_ttl
+        lease.refresh.return_value = [mock.Mock(TTL=self.cfg.status_ttl)]
+        self.cfg._status_leases[self.uuid] = lease
+
+        # Someone else has downed the service and moved it to another region
+        current = self._service()
+        current.status = service.Status.DOWN
+        current.region = 'us-west'
+        self.etcd.transaction.side_effect = [
+            (False, [[(current.SerializeToString(), mock.Mock(version=5))]]),
+            (True, []),
+        ]
+
+        s.status = service.Status.DOWN
+        service.update(self.cfg, s)
+
+        self.assertFalse(self.etcd.get.called)
+        self.assertEqual(2, self.etcd.transaction.call_count)
+        # The retry is diffed against the record returned by the failed
+        # transaction, so only the region index needs fixing up
+        self.etcd.transactions.delete.assert_called_with(
+            "/services/by-region/us-west/" + self.uuid,
+        )
+        self.assertEqual(
+            (s.SerializeToString(), 6),
+            self.cfg._last_written[self.uuid],
+        )
+
+    def test_delete_skips_read(self):
+        s = self._service()
+        self.cfg._last_written[self.uuid] = (s.SerializeToString(), 3)
+        self.etcd.transaction.return_value = (
+            True, [[(b'', mock.Mock(lease_id=42))]],
+        )
+
+        service.delete(self.cfg, uuid=self.uuid)
+
+        self.assertFalse(self.etcd.get.called)
+        # The status key's lease is revoked, so that the service's owner
+        # notices the deletion on its next heartbeat
+        self.etcd.transactions.get.assert_any_call(
+            "/services/by-status/UP/" + self.uuid,
+        )
+        self.etcd.revoke_lease.assert_called_once_with(42)
+        self.etcd.transactions.delete.assert_any_call(
+            "/services/by-region/us-east/" + self.uuid,
+        )
+        # The region key shared with services created by older releases is
+        # left for reindex() to remove
+        self.assertNotIn(
+            mock.call("/services/by-region/us-east"),
+            self.etcd.transactions.delete.call_args_list,
+        )
+        self.assertEqual(1, self.etcd.transaction.call_count)
+        self.assertNotIn(self.uuid, self.cfg._last_written)
+
+    def test_update_after_deleted_elsewhere(self):
+        s = self._service()
+        self.cfg._last_written[self.uuid] = (s.SerializeToString(), 3)
+        lease = self.etcd.lease.return_value
+        lease.ttl = self.cfg.status_ttl
+        self.cfg._status_leases[self.uuid] = lease
+        # Another process deleted the service, revoking its status lease
+        lease.refresh.return_value = [mock.Mock(TTL=0)]
+        self.etcd.transaction.side_effect = [
+            # The record we last wrote is gone...
+            (False, [[]]),
+            # ...so it is created again
+            (True, []),
+        ]
+
+        service.update(self.cfg, s)
+
+        self.assertEqual(2, self.etcd.transaction.call_count)
+        self.etcd.lease.assert_called_once_with(ttl=self.cfg.status_ttl)
+        self.etcd.transactions.put.assert_any_call(
+            "/services/by-type-host/nova-compute/localhost", value=self.uuid,
+        )
+        self.etcd.transactions.put.assert_any_call(
+            "/services/by-status/UP/" + self.uuid, value='', lease=lease,
+        )
+        self.assertEqual(
+            (s.SerializeToString(), 1),
+            self.cfg._last_written[self.uuid],
+        )
+
+    def test_delete_not_found(self):
+        self.etcd.get.return_value = self._NOT_FOUND
+        self.assertIsNone(service.delete(self.cfg, uuid=self.uuid))
+        self.assertFalse(self.etcd.transaction.called)
+
+    def test_update_many_new_services(self):
+        services = []
+        for x in range(3):
+            s = self._service()
+            s.uuid = uuid.uuid4().hex
+            s.host = 'host%d' % x
+            services.append(s)
+        self.etcd.transaction.side_effect = [
+            # None of the services exist yet...
+            (True, [[], [], []]),
+            # ...so they are all created in one transaction
+            (True, []),
+        ]
+
+        service.update_many(self.cfg, services)
+
+        self.assertEqual(2, self.etcd.transaction.call_count)
+        self.assertEqual(3, self.etcd.lease.call_count)
+        self.assertEqual(12, self.etcd.transactions.put.call_count)
+        lease = self.etcd.lease.return_value
+        for s in services:
+            self.assertEqual(
+                (s.SerializeToString(), 1),
+                self.cfg._last_written[s.uuid],
+            )
+            self.assertIs(lease, self.cfg._status_leases[s.uuid])
+
+    def test_update_many_created_elsewhere(self):
+        s = self._service()
+        # A lease is cached from before the service was deleted elsewhere
+        lease = self.etcd.lease.return_value
+        lease.ttl = self.cfg.status_ttl
+        lease.refresh.return_value = [mock.Mock(TTL=self.cfg.status_ttl)]
+        self.cfg._status_leases[self.uuid] = lease
+        self.etcd.transaction.side_effect = [
+            # The service does not exist yet...
+            (True, [[]]),
+            # ...but has been created by someone else by the time it is
+            (False, []),
+            # The fallback update() attaches a new lease
+            (True, []),
+        ]
+        self.etcd.get.return_value = (
+            s.SerializeToString(), mock.Mock(version=1),
+        )
+
+        service.update_many(self.cfg, [s])
+
+        self.assertEqual(3, self.etcd.transaction.call_count)
+        self.etcd.lease.assert_called_once_with(ttl=self.cfg.status_ttl)
+        self.etcd.transactions.put.assert_called_with(
+            "/services/by-uuid/" + self.uuid,
+            value=s.SerializeToString(),
+        )
+        self.etcd.transactions.put.assert_any_call(
+            "/services/by-status/UP/" + self.uuid, value='', lease=lease,
+        )
+        self.assertEqual(
+            (s.SerializeToString(), 2),
+            self.cfg._last_written[self.uuid],
+        )
+
+    def test_update_expired_lease_regranted(self):
+        s = self._service()
+        meta = mock.Mock(version=1)
+        self.etcd.get.return_value = (s.SerializeToString(), meta)
+        lease = self.etcd.lease.return_value
+        lease.ttl = self.cfg.status_ttl
+        lease.refresh.return_value = [mock.Mock(TTL=0)]
+
+        service.update(self.cfg, s)
+        service.update(self.cfg, s)
+        self.assertEqual(2, self.etcd.lease.call_count)
+        self.assertEqual(2, self.etcd.transaction.call_count)
+
+    def test_start_heartbeat(self):
+        s = self._service()
+        meta = mock.Mock(version=1)
+        self.etcd.get.return_value = (s.SerializeToString(), meta)
+        lease = self.etcd.lease.return_value
+        lease.ttl = self.cfg.status_ttl
+        refreshed = threading.Event()
+
+        def refresh():
+            refreshed.set()
+            return [mock.Mock(TTL=self.cfg.status_ttl)]
+
+        lease.refresh.side_effect = refresh
+
+        hb = service.start_heartbeat(self.cfg, s, interval=0.01)
+        self.assertTrue(refreshed.wait(5))
+        hb.stop()
+        # Only the initial update() wrote to etcd
+        self.etcd.lease.assert_called_once_with(ttl=self.cfg.status_ttl)
+        self.assertEqual(1, self.etcd.transaction.call_count)
+
+    @mock.patch.object(service, 'update')
+    @mock.patch.object(service, 'get_one')
+    def test_down_maintenance_times_utc(self, get_one, update):
+        get_one.return_value = self._service()
+        service.down(
+            self.cfg,
+            maint_note='Failed disk',
+            maint_start=datetime.datetime(2019, 1, 1),
+            maint_end=datetime.datetime(2019, 1, 2),
+            uuid=self.uuid,
+        )
+        s = update.call_args[0][1]
+        self.assertEqual(service.Status.DOWN, s.status)
+        self.assertEqual(1546300800, s.maintenance_start)
+        self.assertEqual(1546387200, s.maintenance_end)
+
+        # Aware datetimes are converted to UTC first
+        service.down(
+            self.cfg,
+            maint_note='Failed disk',
+            maint_start=datetime.datetime(2019, 1, 1, 2, tzinfo=_UTC_PLUS_2),
+            uuid=self.uuid,
+        )
+        s = update.call_args[0][1]
+        self.assertEqual(1546300800, s.maintenance_start)
+
+    def test_fields_changed(self):
+        orig = self._service()
+        new = self._service()
+        self.assertEqual(set(), service._fields_changed(orig, new))
+        new.status = service.Status.DOWN
+        new.maintenance_note = 'Failed disk'
+        self.assertEqual(
+            set(['status', 'maintenance_note']),
+            service._fields_changed(orig, new),
+        )
 
     def test_status_itoa(self):
         val_map = {